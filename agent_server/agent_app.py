@@ -4,6 +4,8 @@ FastAPI application exposing the agent's entrypoints.
 
 Endpoints:
   - POST /ask: main entry for user messages; returns a reply generated by the agent.
+  - POST /ask/stream: same as /ask, but streams the reply as server-sent events
+    (`data: {"delta": "..."}` per chunk, then `data: {"done": true, "source": "..."}`).
   - POST /webhook/bank: called by the banking server when an OTP is sent or verified.
 
 The webhook uses a shared `SERVICE_TOKEN` for authentication.  When an OTP is sent, the
@@ -12,17 +14,28 @@ is verified, the resulting access token is stored and any pending action is resu
 """
 
 from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import Optional
+from typing import Iterator
+import asyncio
+import json
 import os
 
-from service import handle_ask, PENDING_ACTIONS, synthesize_reply
-from memory_manager import get_chat_history
-from bank_tool import save_token, get_account_summary as bt_get_account_summary
+from service import handle_ask, get_pending_action, pop_pending_action, asynthesize_reply, recent_turns, LLM_EXECUTOR
+from memory_manager import get_chat_history, format_history, ar as aredis_client
+from bank_tool import a_save_token, a_get_account_summary as bt_get_account_summary, aclose_async_client
 from config import SERVICE_TOKEN
 
 
-app = FastAPI(title="Agent: Gemini planner + Ollama answer")
+app = FastAPI(title="Agent: Gemini planner + Ollama answer", default_response_class=ORJSONResponse)
+
+
+@app.on_event("shutdown")
+async def _shutdown_event() -> None:
+    await aclose_async_client()
+    await aredis_client.aclose()
+    LLM_EXECUTOR.shutdown(wait=False, cancel_futures=True)
 
 
 class AskRequest(BaseModel):
@@ -33,10 +46,10 @@ class AskRequest(BaseModel):
 
 
 @app.post("/ask")
-def ask(req: AskRequest):
+async def ask(req: AskRequest):
     """Endpoint for handling user messages."""
     user_id = req.account_id or req.phone_num
-    return handle_ask(
+    return await handle_ask(
         user_id=user_id,
         prompt=req.message,
         account_id=req.account_id,
@@ -45,6 +58,41 @@ def ask(req: AskRequest):
     )
 
 
+def _sse(data: dict) -> str:
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _sse_events(result: dict) -> Iterator[str]:
+    # Sync generator: StreamingResponse iterates it in the threadpool, so the blocking
+    # Ollama stream inside `reply_stream` never touches the event loop.
+    chunks = result.get("reply_stream")
+    try:
+        if chunks is None:
+            yield _sse({"delta": result.get("reply", "")})
+        else:
+            for chunk in chunks:
+                yield _sse({"delta": chunk})
+        yield _sse({"done": True, "source": result.get("source")})
+    except Exception as e:
+        yield _sse({"error": str(e)})
+
+
+@app.post("/ask/stream")
+async def ask_stream(req: AskRequest):
+    """Like /ask, but the LLM answer is streamed to the client as it is generated."""
+    user_id = req.account_id or req.phone_num
+    result = await handle_ask(
+        user_id=user_id,
+        prompt=req.message,
+        account_id=req.account_id,
+        bank_name=req.bank_name,
+        phone_num=req.phone_num,
+        stream=True
+    )
+    return StreamingResponse(_sse_events(result), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @app.post("/webhook/bank")
 async def bank_webhook(req: Request):
     """
@@ -64,10 +112,14 @@ async def bank_webhook(req: Request):
     user_id = phone  # Map phone to user session id
     chat_history = get_chat_history(user_id)
 
+    def say(text: str):
+        # Redis write is blocking -> keep it off the event loop
+        return asyncio.to_thread(chat_history.add_ai_message, text)
+
     if event == "otp_sent":
         # Show OTP text directly in chat (no real SMS needed)
         text = payload.get("text", "OTP đã gửi.")
-        chat_history.add_ai_message(f"[Ngân hàng {bank}] {text}")
+        await say(f"[Ngân hàng {bank}] {text}")
         return {"ok": True}
     
     if event == "otp_verified":
@@ -76,36 +128,39 @@ async def bank_webhook(req: Request):
         account_id = payload.get("account_id")
         if token:
             # LƯU ĐÚNG CHỮ KÝ
-            save_token(phone, bank, account_id, token, ttl_seconds=ttl)
+            await a_save_token(phone, bank, account_id, token, ttl_seconds=ttl)
         # Try to resume any pending action: get balance after OTP
-        pending = PENDING_ACTIONS.get(user_id)
+        pending = await get_pending_action(user_id)
         if pending:
             try:
-                safe = bt_get_account_summary(account_id=pending.get("account_id"), phone_num=phone, bank_name=bank)
-                context = "\n".join([f"{m.type}: {m.content}" for m in chat_history.messages])
-                ans = synthesize_reply(
+                safe = await bt_get_account_summary(account_id=pending.get("account_id"), phone_num=phone, bank_name=bank)
+                messages = await asyncio.to_thread(lambda: chat_history.messages)
+                context = format_history(messages)
+                ans = await asynthesize_reply(
                     "Tự động tiếp tục sau khi OTP xác thực",
                     "get_account_summary",
                     tool_data=safe,
-                    context=context
+                    context=context,
+                    recent=recent_turns(user_id, messages)
                 )
-                chat_history.add_ai_message(ans)
-                PENDING_ACTIONS.pop(user_id, None)
+                await say(ans)
+                await pop_pending_action(user_id)
                 return {"ok": True, "resumed": True}
             except Exception as e:
-                chat_history.add_ai_message(f"[Ngân hàng {bank}] OTP đã xác thực, nhưng xảy ra lỗi: {e}")
+                await say(f"[Ngân hàng {bank}] OTP đã xác thực, nhưng xảy ra lỗi: {e}")
                 return {"ok": True, "resumed": False, "error": str(e)}
         # If no pending action, simply acknowledge
-        chat_history.add_ai_message(f"[Ngân hàng {bank}] OTP đã xác thực.")
+        await say(f"[Ngân hàng {bank}] OTP đã xác thực.")
         return {"ok": True, "resumed": False}
     if event == "message":
         text = payload.get("text", "")
         if text:
-            chat_history.add_ai_message(f"[{bank}] {text}")
+            await say(f"[{bank}] {text}")
         return {"ok": True}
     return {"ok": False, "message": "unknown event"}
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("agent_app:app", host="0.0.0.0", port=int(os.getenv("PORT", 8000)), reload=True)
\ No newline at end of file
+    uvicorn.run("agent_app:app", host="0.0.0.0", port=int(os.getenv("PORT", 8000)), reload=True,
+                loop="uvloop", http="httptools")
\ No newline at end of file
@@ -3,24 +3,136 @@ bank_tool.py
 Open Banking Hub client: đa người dùng, đa ngân hàng, đa tài khoản.
 Quy tắc endpoint (hub 1 host, route theo bank_name):
   - GET  {OPEN_BANKING_HUB}/bank/{bank_name}/accounts/{phone}
+         (Accept: application/x-ndjson -> 1 account/dòng; Hub cũ vẫn trả JSON array)
   - POST {OPEN_BANKING_HUB}/bank/{bank_name}/balance
   - POST {OPEN_BANKING_HUB}/bank/{bank_name}/otp/verify
   - GET  {OPEN_BANKING_HUB}/bank/{bank_name}/services?query=...
+  - POST {OPEN_BANKING_HUB}/accounts/bulk  body {"phone": ..., "banks"?: [...]}
+         -> {bank: [account, ...]}: mọi bank user có account, mỗi account cùng dạng với
+            /bank/{bank_name}/accounts/{phone}. Hub cũ trả 404 -> client fan-out từng bank.
+
+Các tool gọi Hub/RAG là coroutine `a_*` (httpx.AsyncClient, HTTP/2 khi Hub chạy TLS);
+chỉ `get_supported_banks` còn sync (requests.Session) vì được gọi qua asyncio.to_thread.
 """
 
+import asyncio
 import time
+import threading
+from contextlib import aclosing
+import cachetools
+import httpx
+import redis
 import requests
-from typing import Dict, Any, List, Optional
-from config import RAG_SERVICE_URL
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import Dict, Any, AsyncIterator, List, Optional, Tuple
+
+try:
+    import orjson
+
+    def _loads(b: bytes) -> Any:
+        return orjson.loads(b)
+except ImportError:  # orjson chưa cài -> dùng json chuẩn
+    import json
+
+    def _loads(b: bytes) -> Any:
+        return json.loads(b)
+from config import RAG_SERVICE_URL, ACCOUNTS_CACHE_TTL
 from rag_tool import resolve_bank_collection
+from memory_manager import ar as aredis_client
 
 # Hub base URL (string)
 OPEN_BANKING_HUB = "http://localhost:4000"
 
-# In-memory token store (demo)
-# key = f"{bank}:{phone}:{account_id}"
-TOKEN_STORE: Dict[str, Dict[str, Any]] = {}
-PENDING_OTP: Dict[str, Dict[str, Any]] = {}
+
+def _build_session() -> requests.Session:
+    """Session dùng chung: keep-alive + connection pool, retry nhẹ khi gateway lỗi."""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=64,
+        max_retries=Retry(total=2, backoff_factor=0.1, status_forcelist=[502, 503, 504]),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# Chỉ còn dùng cho get_supported_banks (sync, chạy trong thread)
+_SESSION = _build_session()
+
+# Client async dùng chung: các request tới Hub multiplex trên ít connection
+_ACLIENT = httpx.AsyncClient(http2=True, timeout=10.0, limits=httpx.Limits(max_connections=32))
+
+
+async def aclose_async_client() -> None:
+    await _ACLIENT.aclose()
+
+class ExpiringStore:
+    """
+    Dict key -> record có "expires". Record hết hạn bị bỏ khi đọc trúng key, và định kỳ
+    (mỗi `sweep_interval` giây, chạy lúc ghi) quét toàn bộ để store không phình mãi.
+    """
+
+    def __init__(self, default_ttl: float, sweep_interval: float = 300.0) -> None:
+        self.default_ttl = default_ttl
+        self.sweep_interval = sweep_interval
+        self._d: Dict[str, Dict[str, Any]] = {}
+        self._last_sweep = 0.0
+        self._lock = threading.Lock()
+
+    def set(self, key: str, value: Dict[str, Any], ttl: Optional[float] = None) -> None:
+        now = _now()
+        with self._lock:
+            self._d[key] = {**value, "expires": now + (ttl if ttl is not None else self.default_ttl)}
+            if now - self._last_sweep > self.sweep_interval:
+                self._d = {k: v for k, v in self._d.items() if v["expires"] > now}
+                self._last_sweep = now
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        rec = self._d.get(key)
+        if rec and rec["expires"] > _now():
+            return rec
+        if rec:
+            self._d.pop(key, None)
+        return None
+
+    def pop(self, key: str) -> Optional[Dict[str, Any]]:
+        return self._d.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._d)
+
+
+# Token store 2 tầng: Redis (chia sẻ giữa các worker) + TOKEN_STORE làm L1 trong process
+# key = f"{bank}:{phone}:{account_id}", Redis key = f"tok:{key}"
+TOKEN_L1_TTL = 30
+TOKEN_STORE = ExpiringStore(default_ttl=TOKEN_L1_TTL)
+# OTP chưa xác minh không nên nằm lâu hơn hạn OTP của Hub (5 phút)
+PENDING_OTP = ExpiringStore(default_ttl=300)
+
+# Danh sách bank ít thay đổi -> cache ngắn hạn thay vì gọi /health mỗi query
+BANKS_CACHE_TTL = 60.0
+_BANKS_CACHE: Dict[str, Any] = {"value": None, "expires": 0.0}
+_BANKS_LOCK = threading.Lock()
+
+# Kết quả a_search_services thành công theo (bank_name, query chuẩn hóa), giữ 300s
+_SERVICES_CACHE: cachetools.TTLCache = cachetools.TTLCache(maxsize=256, ttl=300)
+_SERVICES_LOCK = threading.Lock()
+
+# False khi Hub trả 404 cho /accounts/bulk -> không tốn thêm 1 RTT thử lại mỗi lần
+_BULK_SUPPORTED = True
+
+# key = _key(bank, phone) -> (accounts, {accountId: account}); gom các GET trùng trong cùng một lượt hội thoại.
+# TTLCache có maxsize nên (bank, phone) cũ bị loại, không giữ mãi account/giao dịch trong RAM
+ACCOUNTS_CACHE_SIZE = 1024
+_ACCTS_CACHE: cachetools.TTLCache = cachetools.TTLCache(maxsize=ACCOUNTS_CACHE_SIZE, ttl=ACCOUNTS_CACHE_TTL)
+_ACCTS_LOCK = threading.Lock()
+
+
+def _cached_accounts(key: str) -> Optional[Tuple[List[Dict[str, Any]], Dict[str, Dict[str, Any]]]]:
+    with _ACCTS_LOCK:
+        return _ACCTS_CACHE.get(key)
 
 
 class NeedOTP(Exception):
@@ -38,55 +150,50 @@ def _key(bank: str, phone: str, account_id: Optional[str] = None) -> str:
 def _now() -> float:
     return time.time()
 
-def get_supported_banks() -> list[str]:
-    url = f"{OPEN_BANKING_HUB}/health"
-    r = requests.get(url, timeout=5)
-    r.raise_for_status()
-    data = r.json()
-    return data.get("banks", [])
 
+def _json(r) -> Any:
+    """Parse body của response (requests hoặc httpx) bằng orjson nếu có."""
+    return _loads(r.content)
 
-def get_cached_token(phone: str, bank_name: str, account_id: str) -> Optional[str]:
-    key = _key(bank_name, phone, account_id)
-    rec = TOKEN_STORE.get(key)
-    if rec and rec.get("expires", 0) > _now():
-        return rec["token"]
-    if rec:
-        del TOKEN_STORE[key]
+def get_supported_banks() -> list[str]:
+    if _BANKS_CACHE["value"] is not None and _now() < _BANKS_CACHE["expires"]:
+        return list(_BANKS_CACHE["value"])
+    # lock để nhiều request đồng thời không cùng dồn vào Hub khi cache hết hạn
+    with _BANKS_LOCK:
+        if _BANKS_CACHE["value"] is not None and _now() < _BANKS_CACHE["expires"]:
+            return list(_BANKS_CACHE["value"])
+        url = f"{OPEN_BANKING_HUB}/health"
+        r = _SESSION.get(url, timeout=5)
+        r.raise_for_status()
+        data = _json(r)
+        banks = data.get("banks", [])
+        _BANKS_CACHE["value"] = banks
+        _BANKS_CACHE["expires"] = _now() + BANKS_CACHE_TTL
+        return list(banks)
+
+
+def invalidate_supported_banks() -> None:
+    _BANKS_CACHE["value"] = None
+    _BANKS_CACHE["expires"] = 0.0
+
+
+def _remember_token(key: str, token: Optional[str], ttl: Optional[int]) -> Optional[str]:
+    if token and ttl and ttl > 0:
+        TOKEN_STORE.set(key, {"token": token}, ttl=min(TOKEN_L1_TTL, ttl))
+        return token
     return None
 
 
-def save_token(phone: str, bank_name: str, account_id: str, token: str, ttl_seconds: int = 600) -> None:
-    key = _key(bank_name, phone, account_id)
-    TOKEN_STORE[key] = {"token": token, "expires": _now() + ttl_seconds}
+def _mark_pending_otp(phone: str, bank_name: str, action: str, account_id: str) -> None:
+    PENDING_OTP.set(_key(bank_name, phone, account_id), {
+        "action": action, "account_id": account_id, "created": _now()
+    })
 
 
-def request_otp_for_action(phone: str, bank_name: str, action: str = "get_account_summary", account_id: Optional[str] = None) -> Dict[str, Any]:
-    """Yêu cầu OTP tại Hub (đa ngân hàng)."""
-    if not OPEN_BANKING_HUB:
-        raise ValueError("OPEN_BANKING_HUB chưa cấu hình")
-    if not account_id:
-        raise ValueError("account_id là bắt buộc với flow OTP demo này")
-
-    payload = {"phone": phone, "account_id": account_id, "action": action}
-    url = f"{OPEN_BANKING_HUB}/bank/{bank_name}/balance"
-    r = requests.post(url, json=payload, timeout=10)
-    if r.status_code < 400:
-        PENDING_OTP[_key(bank_name, phone, account_id)] = {
-            "action": action, "account_id": account_id, "created": _now()
-        }
-        return r.json()
-    raise RuntimeError(f"Không gọi được request_otp: {r.text}")
-
-
-def verify_otp_and_get_token(phone: str, otp: str, bank_name: str, account_id: str) -> Dict[str, Any]:
-    url = f"{OPEN_BANKING_HUB}/bank/{bank_name}/otp/verify"
-    payload = {"phone": phone, "otp": otp, "account_id": account_id}
-    r = requests.post(url, json=payload, timeout=10)
-    data = r.json()
-    token = data.get("access_token")
+def _after_verify(phone: str, bank_name: str, account_id: str, token: Optional[str], data: Dict[str, Any]) -> Dict[str, Any]:
     if token:
-        save_token(phone, bank_name, account_id, token, ttl_seconds=int(data.get("ttl", 600)))
+        # user vừa liên kết xong -> đọc lại trạng thái mới từ Hub
+        invalidate_accounts(phone, bank_name)
     PENDING_OTP.pop(_key(bank_name, phone, account_id), None)
 
     account_summary = data.get("account_summary")
@@ -96,53 +203,42 @@ def verify_otp_and_get_token(phone: str, otp: str, bank_name: str, account_id: s
     return {"token": token, "account_summary": account_summary}
 
 
-def get_accounts(phone_num: str, bank_name: str) -> List[Dict[str, Any]]:
-    """Lấy danh sách account theo user + bank."""
-    url = f"{OPEN_BANKING_HUB}/bank/{bank_name}/accounts/{phone_num}"
-    r = requests.get(url, timeout=10)
-    r.raise_for_status()
-    return r.json() or []
+def _cache_accounts(key: str, accounts: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+    index = {a.get("accountId"): a for a in accounts}
+    with _ACCTS_LOCK:
+        _ACCTS_CACHE[key] = (accounts, index)
+    return accounts, index
+
 
-def list_user_accounts(phone_num: str) -> Dict[str, Any]:
-    banks = get_supported_banks()
+def invalidate_accounts(phone_num: str, bank_name: str) -> None:
+    with _ACCTS_LOCK:
+        _ACCTS_CACHE.pop(_key(bank_name, phone_num), None)
+
+def _project(accounts: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [
+        {"accountId": a["accountId"], "label": a.get("label"), "last_update": a.get("last_update")}
+        for a in accounts
+    ]
+
+
+def _parse_bulk(phone_num: str, data: Dict[str, List[Dict[str, Any]]]) -> Dict[str, Any]:
     result = {}
-    for bank in banks:
-        try:
-            accounts = get_accounts(phone_num, bank)
-            if accounts:
-                result[bank] = [
-                    {"accountId": a["accountId"], "label": a.get("label"), "last_update": a.get("last_update")}
-                    for a in accounts
-                ]
-        except Exception:
-            continue
+    for bank, accounts in (data or {}).items():
+        # account đầy đủ -> nạp luôn vào _ACCTS_CACHE cho a_get_account_summary sau đó
+        _cache_accounts(_key(bank, phone_num), accounts or [])
+        if accounts:
+            result[bank] = _project(accounts)
     return result
 
 
+def _pick_account(acc_list: List[Dict[str, Any]], index: Dict[str, Dict[str, Any]],
+                  account_id: str) -> Optional[Dict[str, Any]]:
+    return index.get(account_id) or (acc_list[0] if acc_list else None)
 
-def get_account_summary(account_id: str, phone_num: str, bank_name: str = "mock") -> Dict[str, Any]:
-    """
-    Nếu chưa có token theo (bank, phone, account_id) -> gửi OTP (NeedOTP).
-    Nếu có token -> (demo) trả về số dư/tx giả lập hoặc gọi thêm endpoint khác nếu bạn bổ sung.
-    """
-    if not OPEN_BANKING_HUB:
-        raise ValueError("OPEN_BANKING_HUB chưa cấu hình")
-
-    # 1) Token theo từng account
-    token = get_cached_token(phone_num, bank_name, account_id)
-    if not token:
-        request_otp_for_action(phone_num, bank_name, action="get_account_summary", account_id=account_id)
-        raise NeedOTP(
-            f"OTP đã được gửi tới {phone_num} bởi {bank_name}",
-            phone=phone_num, bank_name=bank_name, account_id=account_id
-        )
 
-    # 2) Demo: khi có token rồi, đọc lại thông tin account từ users.json để trả về (giả lập)
-    acc_list = get_accounts(phone_num, bank_name)
-    acc = next((a for a in acc_list if a.get("accountId") == account_id), None)
-    if not acc:
-        # fallback: lấy account đầu tiên
-        acc = acc_list[0] if acc_list else {"accountId": account_id, "balance": 0, "label": "Unknown"}
+def _summarize_account(acc: Optional[Dict[str, Any]], account_id: str) -> Dict[str, Any]:
+    # fallback: lấy account đầu tiên
+    acc = acc or {"accountId": account_id, "balance": 0, "label": "Unknown"}
 
     raw = {
         "account_number": acc.get("accountId", account_id),
@@ -157,21 +253,20 @@ def get_account_summary(account_id: str, phone_num: str, bank_name: str = "mock"
 
 def mask_account(acc: str) -> str:
     acc = (acc or "").strip()
-    if len(acc) <= 8:
-        return "****"
-    return acc[:4] + "..." + acc[-4:]
+    return "****" if len(acc) <= 8 else f"{acc[:4]}...{acc[-4:]}"
 
 
 def summarize_transactions(txs: List[Dict[str, Any]], n: int = 5) -> List[Dict[str, Any]]:
     out: List[Dict[str, Any]] = []
     for t in txs[:n]:
-        merchant = t.get("merchant") or t.get("merchant_name") or t.get("mo_ta") or "[masked]"
+        g = t.get
+        merchant = g("merchant") or g("merchant_name") or g("mo_ta") or "[masked]"
         merchant = merchant if len(merchant) <= 30 else merchant[:27] + "..."
         out.append({
-            "date": t.get("date") or t.get("ngay"),
-            "amount": t.get("amount") or t.get("so_tien_vnd"),
+            "date": g("date") or g("ngay"),
+            "amount": g("amount") or g("so_tien_vnd"),
             "merchant": merchant,
-            "type": t.get("type") or t.get("danh_muc")
+            "type": g("type") or g("danh_muc")
         })
     return out
 
@@ -185,33 +280,184 @@ def sanitize_bank_response(raw: Dict[str, Any]) -> Dict[str, Any]:
     }
 
 
-def search_services(query: str, bank_name: str = "mock_bank") -> str:
-    col_name = resolve_bank_collection(bank_name)
-    if not col_name:
-        return f"❌ Không tìm thấy collection cho ngân hàng {bank_name}"
+def _services_key(query: str, bank_name: str) -> Tuple[str, str]:
+    return bank_name, query.lower().strip()
+
+
+def _cached_services(key: Tuple[str, str]) -> Optional[str]:
+    with _SERVICES_LOCK:
+        return _SERVICES_CACHE.get(key)
+
+
+def _remember_services(key: Tuple[str, str], text: str) -> str:
+    with _SERVICES_LOCK:
+        _SERVICES_CACHE[key] = text
+    return text
+
+
+def _format_services(hits: List[Dict[str, Any]]) -> str:
+    if hits:
+        lines = ["Các dịch vụ gợi ý:"]
+        for h in hits:
+            lines.append(f"- {h.get('text')}")
+        return "\n".join(lines)
+    return "Không tìm thấy dịch vụ phù hợp"
 
+
+# --- Hub / RAG client (httpx) ---
+
+async def a_get_cached_token(phone: str, bank_name: str, account_id: str) -> Optional[str]:
+    key = _key(bank_name, phone, account_id)
+    rec = TOKEN_STORE.get(key)
+    if rec:
+        return rec["token"]
     try:
-        payload = {"bank_name": col_name, "query": query, "k": 5}
-        url = f"{RAG_SERVICE_URL}/rag/search"
+        token, ttl = await aredis_client.pipeline().get(f"tok:{key}").ttl(f"tok:{key}").execute()
+    except redis.RedisError as e:
+        print("Token store (redis) error:", e)
+        return None
+    return _remember_token(key, token, ttl)
+
 
-        print("📡 Request chuẩn bị gửi:")
-        print("   URL:", url)
-        print("   Body:", payload)
+async def a_save_token(phone: str, bank_name: str, account_id: str, token: str, ttl_seconds: int = 600) -> None:
+    key = _key(bank_name, phone, account_id)
+    TOKEN_STORE.set(key, {"token": token}, ttl=min(TOKEN_L1_TTL, ttl_seconds))
+    try:
+        await aredis_client.setex(f"tok:{key}", ttl_seconds, token)
+    except redis.RedisError as e:
+        print("Token store (redis) error:", e)
+
+
+async def _a_get_accounts_entry(phone_num: str, bank_name: str) -> Tuple[List[Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+    """Trả về (accounts, index theo accountId), dùng cache ngắn hạn ACCOUNTS_CACHE_TTL."""
+    key = _key(bank_name, phone_num)
+    hit = _cached_accounts(key)
+    if hit:
+        return hit
+    r = await _ACLIENT.get(f"{OPEN_BANKING_HUB}/bank/{bank_name}/accounts/{phone_num}")
+    r.raise_for_status()
+    return _cache_accounts(key, _json(r) or [])
+
+
+async def a_iter_accounts(phone_num: str, bank_name: str) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Stream account từ Hub dạng NDJSON để caller dừng sớm (vd. khi đã gặp accountId cần tìm)
+    mà không phải đọc/parse phần còn lại. Hub trả JSON array thì parse 1 lần như cũ.
+    """
+    url = f"{OPEN_BANKING_HUB}/bank/{bank_name}/accounts/{phone_num}"
+    headers = {"Accept": "application/x-ndjson, application/json;q=0.9"}
+    async with _ACLIENT.stream("GET", url, headers=headers) as r:
+        r.raise_for_status()
+        if "ndjson" in r.headers.get("Content-Type", ""):
+            async for line in r.aiter_lines():
+                if line:
+                    yield _loads(line)
+        else:
+            await r.aread()
+            for acc in _json(r) or []:
+                yield acc
+
+
+async def a_get_accounts(phone_num: str, bank_name: str) -> List[Dict[str, Any]]:
+    """Lấy danh sách account theo user + bank."""
+    return list((await _a_get_accounts_entry(phone_num, bank_name))[0])
 
-        resp = requests.post(url, json=payload, timeout=10)
-        print("   Status:", resp.status_code)
 
+async def a_list_user_accounts(phone_num: str) -> Dict[str, Any]:
+    """1 RTT cho mọi bank qua /accounts/bulk; Hub chưa hỗ trợ (404) thì fan-out song song từng bank."""
+    global _BULK_SUPPORTED
+    if _BULK_SUPPORTED:
+        try:
+            r = await _ACLIENT.post(f"{OPEN_BANKING_HUB}/accounts/bulk", json={"phone": phone_num})
+            if r.status_code == 404:
+                _BULK_SUPPORTED = False
+            else:
+                r.raise_for_status()
+                return _parse_bulk(phone_num, _json(r))
+        except Exception as e:
+            print("Bulk accounts error, fallback fan-out:", e)
+    banks = await asyncio.to_thread(get_supported_banks)
+    results = await asyncio.gather(*[a_get_accounts(phone_num, b) for b in banks], return_exceptions=True)
+    return {
+        b: _project(accounts)
+        for b, accounts in zip(banks, results)
+        if accounts and not isinstance(accounts, BaseException)
+    }
+
+
+async def a_request_otp_for_action(phone: str, bank_name: str, action: str = "get_account_summary", account_id: Optional[str] = None) -> Dict[str, Any]:
+    """Yêu cầu OTP tại Hub (đa ngân hàng)."""
+    if not OPEN_BANKING_HUB:
+        raise ValueError("OPEN_BANKING_HUB chưa cấu hình")
+    if not account_id:
+        raise ValueError("account_id là bắt buộc với flow OTP demo này")
+
+    payload = {"phone": phone, "account_id": account_id, "action": action}
+    r = await _ACLIENT.post(f"{OPEN_BANKING_HUB}/bank/{bank_name}/balance", json=payload)
+    if r.status_code < 400:
+        _mark_pending_otp(phone, bank_name, action, account_id)
+        return _json(r)
+    raise RuntimeError(f"Không gọi được request_otp: {r.text}")
+
+
+async def a_verify_otp_and_get_token(phone: str, otp: str, bank_name: str, account_id: str) -> Dict[str, Any]:
+    payload = {"phone": phone, "otp": otp, "account_id": account_id}
+    r = await _ACLIENT.post(f"{OPEN_BANKING_HUB}/bank/{bank_name}/otp/verify", json=payload)
+    data = _json(r)
+    token = data.get("access_token")
+    if token:
+        await a_save_token(phone, bank_name, account_id, token, ttl_seconds=int(data.get("ttl", 600)))
+    return _after_verify(phone, bank_name, account_id, token, data)
+
+
+async def a_get_account_summary(account_id: str, phone_num: str, bank_name: str = "mock") -> Dict[str, Any]:
+    """
+    Nếu chưa có token theo (bank, phone, account_id) -> gửi OTP (NeedOTP).
+    Nếu có token -> (demo) trả về số dư/tx giả lập hoặc gọi thêm endpoint khác nếu bạn bổ sung.
+    """
+    if not OPEN_BANKING_HUB:
+        raise ValueError("OPEN_BANKING_HUB chưa cấu hình")
+
+    token = await a_get_cached_token(phone_num, bank_name, account_id)
+    if not token:
+        await a_request_otp_for_action(phone_num, bank_name, action="get_account_summary", account_id=account_id)
+        raise NeedOTP(
+            f"OTP đã được gửi tới {phone_num} bởi {bank_name}",
+            phone=phone_num, bank_name=bank_name, account_id=account_id
+        )
+
+    hit = _cached_accounts(_key(bank_name, phone_num))
+    if hit:
+        acc = _pick_account(*hit, account_id)
+    else:
+        # chưa có cache -> stream và dừng ngay khi gặp account cần tìm
+        acc = first = None
+        async with aclosing(a_iter_accounts(phone_num, bank_name)) as accounts:
+            async for a in accounts:
+                if first is None:
+                    first = a
+                if a.get("accountId") == account_id:
+                    acc = a
+                    break
+        acc = acc or first
+    return _summarize_account(acc, account_id)
+
+
+async def a_search_services(query: str, bank_name: str = "mock_bank") -> str:
+    """Tìm dịch vụ qua RAG service (resolve collection vẫn sync -> chạy ở thread)."""
+    ckey = _services_key(query, bank_name)
+    cached = _cached_services(ckey)
+    if cached is not None:
+        return cached
+    col_name = await asyncio.to_thread(resolve_bank_collection, bank_name)
+    if not col_name:
+        return f"❌ Không tìm thấy collection cho ngân hàng {bank_name}"
+
+    try:
+        payload = {"bank_name": col_name, "query": query, "k": 5}
+        resp = await _ACLIENT.post(f"{RAG_SERVICE_URL}/rag/search", json=payload)
         resp.raise_for_status()
-        hits = resp.json().get("results", [])
-        print("📩 Response JSON:", hits)
-
-        if hits:
-            lines = ["Các dịch vụ gợi ý:"]
-            for h in hits:
-                lines.append(f"- {h.get('text')}")
-            return "\n".join(lines)
+        return _remember_services(ckey, _format_services(_json(resp).get("results", [])))
     except Exception as e:
         print("Search error:", e)
         return "❌ Lỗi khi tìm kiếm dịch vụ"
-
-    return "Không tìm thấy dịch vụ phù hợp"
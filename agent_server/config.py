@@ -2,32 +2,43 @@
 import os
 from dotenv import load_dotenv
 
-# Load .env file if present
+# Load .env file if present.  This is the only load_dotenv() call in the agent;
+# other modules import their settings from here.
 load_dotenv()
 
 # Configuration variables used across the agent service
 
 # Ollama settings: used for the local LLM that paraphrases final answers
 # OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434/api/generate")
-OLLAMA_URL = "http://localhost:11434/api/generate"
-OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "llama3:8b")
+OLLAMA_URL: str = "http://localhost:11434/api/generate"
+OLLAMA_MODEL: str = os.getenv("OLLAMA_MODEL", "llama3:8b")
+
+# Max concurrent Ollama generations from this worker (keep <= cores available to Ollama)
+LLM_MAX_WORKERS: int = int(os.getenv("LLM_MAX_WORKERS", 2))
 
 # Webhook verification token (must match the banking server)
-SERVICE_TOKEN = os.getenv("SERVICE_TOKEN", "devtoken")
+SERVICE_TOKEN: str = os.getenv("SERVICE_TOKEN", "devtoken")
 
 # Gemini API key for the planner (set via .env)
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
+GEMINI_API_KEY: str = os.getenv("GEMINI_API_KEY", "")
 
 # Redis credentials for chat history storage
-REDIS_HOST = os.getenv("REDIS_HOST", "redis")
-REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
-REDIS_PASS = os.getenv("REDIS_PASS", "")
+REDIS_HOST: str = os.getenv("REDIS_HOST", "redis")
+REDIS_PORT: int = int(os.getenv("REDIS_PORT", 6379))
+REDIS_PASS: str = os.getenv("REDIS_PASS", "")
 
 # Default phone used by UI (virtual id, no real SIM needed)
-DEFAULT_PHONE = os.getenv("DEFAULT_PHONE", "demo:thao")
+DEFAULT_PHONE: str = os.getenv("DEFAULT_PHONE", "demo:thao")
 
-MILVUS_HOST = "127.0.0.1"
-MILVUS_PORT = "19530"
+MILVUS_HOST: str = "127.0.0.1"
+MILVUS_PORT: str = "19530"
 
 # RAG service base URL (for searching banking services)
-RAG_SERVICE_URL = "http://localhost:8002"
\ No newline at end of file
+RAG_SERVICE_URL: str = "http://localhost:8002"
+
+# TTL (seconds) of the per (phone, bank) account list cache in bank_tool
+ACCOUNTS_CACHE_TTL: float = float(os.getenv("ACCOUNTS_CACHE_TTL", 20))
+
+# Chat history sent inline to the LLMs: last N messages, trimmed to a char budget
+CONTEXT_MAX_MESSAGES: int = int(os.getenv("CONTEXT_MAX_MESSAGES", 8))
+CONTEXT_MAX_CHARS: int = int(os.getenv("CONTEXT_MAX_CHARS", 4000))
@@ -6,18 +6,28 @@ This module wraps Google's Gemini models to map user prompts into either a struc
 call (via JSON Schema) or a final free‑text answer.  If a function call is returned, the
 agent server will invoke the corresponding tool (e.g. retrieving account summary or searching
 services) and return the result to the user.
+
+For long conversations the chat history is stored once in a Gemini context cache per user
+(`call_gemini_planner_for_user`), so later turns only send the messages added since.
 """
 
+import asyncio
+import copy
 import os
-from typing import Dict, Any, Optional
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from functools import lru_cache
+from typing import Dict, Any, List, Optional
 
+import cachetools
 import google.generativeai as genai
-from dotenv import load_dotenv
+from google.generativeai import caching  # google-generativeai >= 0.7
 
+# config loads .env on import
 from config import GEMINI_API_KEY
-
-# Load environment variables early (required for API key)
-load_dotenv()
+from memory_manager import format_history
 
 API_KEY = GEMINI_API_KEY or os.getenv("GEMINI_API_KEY")
 if not API_KEY:
@@ -97,25 +107,43 @@ TOOL_CFG = {
     "function_calling_config": {"mode": "ANY"}
 }
 
-def _build_model():
-    """Try to instantiate gemini-2.5-pro, fall back to gemini-2.0-flash if not available."""
+
+def _to_tool_config_proto(cfg: Dict[str, Any]):
+    """
+    Convert TOOL_CFG to the SDK's ToolConfig proto once, so generate_content only does an
+    isinstance check per call.  (TOOLS and GEN_CFG are already converted once, when the
+    model is built.)  Falls back to the plain dict on SDKs without `to_tool_config`.
+    """
     try:
-        return genai.GenerativeModel(
-            model_name="gemini-2.0-flash",
-            system_instruction=SYSTEM_INSTRUCTION,
-            tools=TOOLS,
-            generation_config=GEN_CFG,
-        )
+        from google.generativeai.types import content_types
+        return content_types.to_tool_config(cfg)
     except Exception:
-        return genai.GenerativeModel(
-            model_name="gemini-2.5-pro",
-            system_instruction=SYSTEM_INSTRUCTION,
-            tools=TOOLS,
-            generation_config=GEN_CFG,
-        )
+        return cfg
+
+
+_TOOL_CFG_PROTO = _to_tool_config_proto(TOOL_CFG)
 
+def _build_model(model_name: str):
+    return genai.GenerativeModel(
+        model_name=model_name,
+        system_instruction=SYSTEM_INSTRUCTION,
+        tools=TOOLS,
+        generation_config=GEN_CFG,
+    )
+
+
+@lru_cache(maxsize=None)
+def get_model():
+    """
+    Build the planner model on first use (not at import) and reuse it afterwards.
+    Uses gemini-2.0-flash; falls back to gemini-2.5-pro only if that fails.
+    """
+    try:
+        return _build_model("gemini-2.0-flash")
+    except Exception as e:
+        print(f"⚠️ gemini-2.0-flash unavailable, falling back to gemini-2.5-pro: {e}")
+        return _build_model("gemini-2.5-pro")
 
-_model = _build_model()
 
 def _extract_function_call(resp) -> Optional[Dict[str, Any]]:
     """Extract the first function call from a Gemini response if present."""
@@ -131,29 +159,168 @@ def _extract_function_call(resp) -> Optional[Dict[str, Any]]:
         pass
     return None
 
+# Per-process LRU of plans keyed by the normalized prompt (strip + lower).  Only successful
+# plans are stored; the original prompt (not the normalized key) is what Gemini sees.
+PLANNER_CACHE_SIZE = 512
+_PLAN_CACHE: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_PLAN_LOCK = threading.Lock()
+
+
+def invalidate_planner_cache() -> None:
+    with _PLAN_LOCK:
+        _PLAN_CACHE.clear()
+
+
+def _plan_uncached(user_prompt: str, model=None, tool_config=_TOOL_CFG_PROTO) -> Dict[str, Any]:
+    resp = (model or get_model()).generate_content(user_prompt, tool_config=tool_config)
+    fc = _extract_function_call(resp)
+    if fc:
+        return {"type": "function_call", **fc}
+
+    # fallback to plain text if no function call
+    text = None
+    try:
+        text = resp.text
+    except Exception:
+        chunks = []
+        for cand in getattr(resp, "candidates", []) or []:
+            for p in getattr(getattr(cand, "content", None), "parts", []) or []:
+                if getattr(p, "text", None):
+                    chunks.append(p.text)
+        text = "".join(chunks).strip() if chunks else ""
+    return {"type": "final", "text": text or ""}
+
+
 def call_gemini_planner(user_prompt: str) -> Dict[str, Any]:
     """
     Generate a plan for the given user prompt.  Returns a dict with:
       - {"type":"function_call", "name": ..., "arguments": {...}}
       - {"type":"final", "text": "..."}
+    Identical prompts (after strip/lower) are answered from an in-process LRU.
     """
+    key = user_prompt.strip().lower()
+    with _PLAN_LOCK:
+        plan = _PLAN_CACHE.get(key)
+        if plan is not None:
+            _PLAN_CACHE.move_to_end(key)
+            return copy.deepcopy(plan)
     try:
-        resp = _model.generate_content(user_prompt, tool_config=TOOL_CFG)
-        fc = _extract_function_call(resp)
-        if fc:
-            return {"type": "function_call", **fc}
+        plan = _plan_uncached(user_prompt)
+    except Exception as e:
+        return {"type": "final", "text": f"(planner lỗi) {str(e)}"}
+    with _PLAN_LOCK:
+        _PLAN_CACHE[key] = plan
+        if len(_PLAN_CACHE) > PLANNER_CACHE_SIZE:
+            _PLAN_CACHE.popitem(last=False)
+    return copy.deepcopy(plan)
+
 
-        # fallback to plain text if no function call
-        text = None
+async def call_gemini_planner_async(user_prompt: str) -> Dict[str, Any]:
+    """`call_gemini_planner` for async handlers; the blocking SDK call runs in a thread."""
+    return await asyncio.to_thread(call_gemini_planner, user_prompt)
+
+
+
+# --- Context cache for the chat-history prefix ---
+CACHE_MODEL = "models/gemini-2.0-flash-001"  # context caching needs a pinned model version
+CACHE_TTL_SECONDS = 600
+CACHE_REFRESH_TURNS = 20
+# The API rejects caches below a minimum token count; ~4 chars per token
+CACHE_MIN_CHARS = 16000
+# Users tracked per process; entries live as long as the server-side cache they point to
+CACHE_MAX_USERS = 4096
+
+# user_id -> {"name": cache name or None, "turns": messages in the cache, "expires": ts}.
+# "name" None means the history was too short to cache; we retry after CACHE_REFRESH_TURNS.
+GEMINI_CACHE_IDS: cachetools.TTLCache = cachetools.TTLCache(maxsize=CACHE_MAX_USERS, ttl=CACHE_TTL_SECONDS)
+# One lock per user so concurrent turns never both create (and pay for) a CachedContent
+_CACHE_LOCKS: cachetools.TTLCache = cachetools.TTLCache(maxsize=CACHE_MAX_USERS, ttl=CACHE_TTL_SECONDS)
+# Guards the two TTLCaches themselves (they are shared by all users' threads)
+_CACHE_IDS_GUARD = threading.Lock()
+
+
+def _user_cache_lock(user_id: str) -> threading.Lock:
+    with _CACHE_IDS_GUARD:
+        lock = _CACHE_LOCKS.get(user_id)
+        if lock is None:
+            lock = _CACHE_LOCKS[user_id] = threading.Lock()
+        return lock
+
+
+def _get_entry(user_id: str) -> Optional[Dict[str, Any]]:
+    with _CACHE_IDS_GUARD:
+        return GEMINI_CACHE_IDS.get(user_id)
+
+
+def _history_text(messages: List[Any]) -> str:
+    return "\n".join([f"{m.type}: {m.content}" for m in messages])
+
+
+@lru_cache(maxsize=128)
+def _cached_model(cache_name: str):
+    return genai.GenerativeModel.from_cached_content(cached_content=cache_name, generation_config=GEN_CFG)
+
+
+def _drop_cache(user_id: str) -> None:
+    with _CACHE_IDS_GUARD:
+        entry = GEMINI_CACHE_IDS.pop(user_id, None)
+    if entry and entry["name"]:
         try:
-            text = resp.text
+            caching.CachedContent.get(entry["name"]).delete()
         except Exception:
-            chunks = []
-            for cand in getattr(resp, "candidates", []) or []:
-                for p in getattr(getattr(cand, "content", None), "parts", []) or []:
-                    if getattr(p, "text", None):
-                        chunks.append(p.text)
-            text = "".join(chunks).strip() if chunks else ""
-        return {"type": "final", "text": text or ""}
-    except Exception as e:
-        return {"type": "final", "text": f"(planner lỗi) {str(e)}"}
\ No newline at end of file
+            pass  # expired already, or never reachable: nothing to clean up
+
+
+def _refresh_cache(user_id: str, past_messages: List[Any]) -> Dict[str, Any]:
+    _drop_cache(user_id)
+    history = _history_text(past_messages)
+    entry = {"name": None, "turns": len(past_messages), "expires": time.time() + CACHE_TTL_SECONDS}
+    if len(history) >= CACHE_MIN_CHARS:
+        try:
+            cache = caching.CachedContent.create(
+                model=CACHE_MODEL,
+                system_instruction=SYSTEM_INSTRUCTION,
+                tools=TOOLS,
+                tool_config=TOOL_CFG,
+                contents=[{"role": "user", "parts": [f"Lịch sử hội thoại:\n{history}"]}],
+                ttl=timedelta(seconds=CACHE_TTL_SECONDS),
+            )
+            entry["name"] = cache.name
+        except Exception as e:
+            print(f"⚠️ Gemini context cache unavailable for {user_id}: {e}")
+    with _CACHE_IDS_GUARD:
+        GEMINI_CACHE_IDS[user_id] = entry
+    return entry
+
+
+def call_gemini_planner_for_user(user_id: str, past_messages: List[Any], prompt: str) -> Dict[str, Any]:
+    """
+    Plan `prompt` given the user's chat history.  Long histories are sent once into a
+    per-user context cache (recreated every CACHE_REFRESH_TURNS messages or on expiry);
+    each call then only sends the messages added since the cache was built.  Falls back to
+    `call_gemini_planner` with the recent history inline (capped like the Ollama context).
+    """
+    n = len(past_messages)
+    lock = _user_cache_lock(user_id)
+    with lock:
+        entry = _get_entry(user_id)
+        # leave a margin so we never send a request against a cache that is about to expire
+        if entry is None or n < entry["turns"] or n - entry["turns"] >= CACHE_REFRESH_TURNS \
+                or time.time() > entry["expires"] - 30:
+            entry = _refresh_cache(user_id, past_messages)
+    if entry["name"]:
+        recent = _history_text(past_messages[entry["turns"]:])
+        try:
+            # tools/tool_config live in the cache; the API rejects them on the request too
+            return _plan_uncached(f"Lịch sử hội thoại (tiếp):\n{recent}\n\nUser hỏi: {prompt}",
+                                  model=_cached_model(entry["name"]), tool_config=None)
+        except Exception as e:
+            print(f"⚠️ Gemini cached plan failed for {user_id}, falling back: {e}")
+            with lock:
+                if _get_entry(user_id) is entry:
+                    _drop_cache(user_id)
+    return call_gemini_planner(f"Lịch sử hội thoại:\n{format_history(past_messages)}\n\nUser hỏi: {prompt}")
+
+
+async def call_gemini_planner_for_user_async(user_id: str, past_messages: List[Any], prompt: str) -> Dict[str, Any]:
+    return await asyncio.to_thread(call_gemini_planner_for_user, user_id, past_messages, prompt)
@@ -8,14 +8,13 @@ to Redis and creating new sessions on demand.
 """
 
 import redis
+import redis.asyncio
 from langchain_community.chat_message_histories import RedisChatMessageHistory
-from dotenv import load_dotenv
+from typing import Any, List
 import os
 
-from config import REDIS_HOST, REDIS_PORT, REDIS_PASS
-
-# Ensure environment variables are loaded
-load_dotenv()
+# config loads .env on import
+from config import REDIS_HOST, REDIS_PORT, REDIS_PASS, CONTEXT_MAX_MESSAGES, CONTEXT_MAX_CHARS
 
 # Construct Redis URL: include password if provided
 if REDIS_PASS:
@@ -24,24 +23,51 @@ if REDIS_PASS:
 else:
     REDIS_URL = f"redis://{REDIS_HOST}:{REDIS_PORT}"
 
-# Instantiate a root redis client (decode_responses ensures we get str values)
-r = redis.from_url(REDIS_URL, decode_responses=True)
+# Root redis clients for the agent's own keys (tokens, pending OTP actions); decode_responses
+# ensures we get str values.  Chat history does not go through these: RedisChatMessageHistory
+# opens its own client from REDIS_URL.  Blocking pools cap the sockets per worker and make a
+# burst wait up to REDIS_POOL_TIMEOUT seconds for a free connection instead of raising
+# "Too many connections".
+REDIS_MAX_CONNECTIONS = 32
+REDIS_POOL_TIMEOUT = 5
+r = redis.Redis(connection_pool=redis.BlockingConnectionPool.from_url(
+    REDIS_URL, decode_responses=True, max_connections=REDIS_MAX_CONNECTIONS, timeout=REDIS_POOL_TIMEOUT))
+# Asyncio counterpart for async handlers (same URL and decoding); from_pool lets aclose()
+# also close the pool
+ar = redis.asyncio.Redis.from_pool(redis.asyncio.BlockingConnectionPool.from_url(
+    REDIS_URL, decode_responses=True, max_connections=REDIS_MAX_CONNECTIONS, timeout=REDIS_POOL_TIMEOUT))
 
 
-def ensure_session(user_id: str, ttl: int = 86400) -> None:
+def ensure_session(user_id: str, ttl: int = 86400) -> RedisChatMessageHistory:
     """
-    Ensure a chat session exists for the given user ID.  If the session does not yet exist,
-    a new `RedisChatMessageHistory` is created with the provided TTL (default: 24 hours).
+    Return the chat session for the given user ID with the provided TTL (default: 24 hours).
+    Construction is idempotent and touches no keys: the Redis list is created on the first
+    message and its TTL is refreshed on every write, so no EXISTS probe is needed.
     """
-    key = f"message_store:{user_id}"
-    if not r.exists(key):
-        RedisChatMessageHistory(session_id=user_id, url=REDIS_URL, ttl=ttl)
-        print(f"✅ Created new session for {user_id}")
-    else:
-        print(f"ℹ️ Session for {user_id} already exists.")
+    return RedisChatMessageHistory(session_id=user_id, url=REDIS_URL, ttl=ttl)
 
 
 def get_chat_history(user_id: str, ttl: int = 86400) -> RedisChatMessageHistory:
-    """Retrieve the chat history object for a given user.  Ensures the session exists first."""
-    ensure_session(user_id, ttl=ttl)
-    return RedisChatMessageHistory(session_id=user_id, url=REDIS_URL, ttl=ttl)
\ No newline at end of file
+    """Retrieve the chat history object for a given user."""
+    return ensure_session(user_id, ttl=ttl)
+
+
+def format_history(messages: List[Any], max_messages: int = CONTEXT_MAX_MESSAGES,
+                   max_chars: int = CONTEXT_MAX_CHARS) -> str:
+    """
+    Render the most recent messages as "type: content" lines for an LLM prompt.  At most
+    `max_messages` are kept, and older ones are dropped until the text fits `max_chars`,
+    so prompt size stays bounded however long the session grows.
+    """
+    lines: List[str] = []
+    used = 0
+    for m in reversed(messages[-max_messages:]):
+        line = f"{m.type}: {m.content}"
+        if not lines and len(line) > max_chars:
+            line = line[-max_chars:]
+        used += len(line) + 1
+        if lines and used > max_chars:
+            break
+        lines.append(line)
+    lines.reverse()
+    return "\n".join(lines)
\ No newline at end of file
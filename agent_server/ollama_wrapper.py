@@ -4,16 +4,20 @@ Simple wrapper around a local LLaMA (served by Ollama) for paraphrasing response
 
 The agent uses Gemini as a planner to decide which tools to call and what information to return.
 Once tool data and/or Gemini text are available, this wrapper helps shape a final natural
-language reply.  The wrapper makes a blocking HTTP call to the Ollama API and returns
-the generated text.
+language reply.  The wrapper streams the Ollama API's NDJSON frames over a keep-alive
+session: `stream` yields text chunks as they are generated, `invoke` joins them.
 """
 
-from typing import Optional, Mapping, Any, List
+from typing import Optional, Mapping, Any, Iterator, List
+import json
 import requests
 from pydantic import BaseModel
 
 from config import OLLAMA_URL, OLLAMA_MODEL
 
+# Every agent turn hits Ollama, so keep the connection alive between calls
+_SESSION = requests.Session()
+
 
 class OllamaConfig(BaseModel):
     url: str = OLLAMA_URL
@@ -26,22 +30,49 @@ class OllamaLLM:
     def __init__(self, config: Optional[OllamaConfig] = None) -> None:
         self.config = config or OllamaConfig()
 
-    def invoke(self, prompt: str, stop: Optional[List[str]] = None) -> str:
+    def stream(self, prompt: str, stop: Optional[List[str]] = None, num_predict: int = 256) -> Iterator[str]:
+        """
+        Yield generated text as it arrives.  Generation ends when Ollama reports `done`
+        or when any `stop` string appears; the stop string itself is not yielded and the
+        connection is closed so the server stops decoding.
+        """
         payload: dict[str, Any] = {
             "model": self.config.model,
             "prompt": prompt,
             "options": {
                 "temperature": 0.2,
-                "num_predict": 256
+                "num_predict": num_predict
             },
-            "stream": False
+            "stream": True
         }
-        if stop:
-            payload["stop"] = stop
-        resp = requests.post(self.config.url, json=payload, timeout=120)
-        resp.raise_for_status()
-        data = resp.json()
-        return data.get("response", "").strip()
+        stops = stop or []
+        if stops:
+            payload["stop"] = stops
+        # Hold back enough characters that a stop string split across frames is not leaked
+        hold = max((len(s) for s in stops), default=1) - 1
+        buf = ""
+        with _SESSION.post(self.config.url, json=payload, timeout=120, stream=True) as resp:
+            resp.raise_for_status()
+            for line in resp.iter_lines():
+                if not line:
+                    continue
+                frame = json.loads(line)
+                buf += frame.get("response", "")
+                cut = min((i for i in (buf.find(s) for s in stops) if i >= 0), default=-1)
+                if cut >= 0:
+                    if cut:
+                        yield buf[:cut]
+                    return
+                if frame.get("done"):
+                    break
+                if len(buf) > hold:
+                    yield buf[:len(buf) - hold]
+                    buf = buf[len(buf) - hold:]
+        if buf:
+            yield buf
+
+    def invoke(self, prompt: str, stop: Optional[List[str]] = None, num_predict: int = 256) -> str:
+        return "".join(self.stream(prompt, stop=stop, num_predict=num_predict)).strip()
 
     @property
     def _identifying_params(self) -> Mapping[str, Any]:
@@ -1,24 +1,72 @@
 # rag_tool.py
-from gemini_planner import _model
+from gemini_planner import get_model
 from pymilvus import utility, connections
 import os
+import time
+from typing import Any, Dict, List, Optional
 from config import MILVUS_HOST, MILVUS_PORT
 
 
+# Cache: tên bank user nhập (lowercase) -> collection; danh sách collection làm mới mỗi 300s
+COLLS_CACHE_TTL = 300.0
+_BANK_COLL_CACHE: Dict[str, Optional[str]] = {}
+_COLLS_CACHE: Dict[str, Any] = {"list": [], "expires": 0.0}
 
-# Hàm helper: đảm bảo đã connect
+
+def _now() -> float:
+    return time.time()
+
+
+# Hàm helper: đảm bảo đã connect (has_connection chỉ kiểm tra local, không tốn RPC)
 def ensure_connected():
     if not connections.has_connection("default"):
         connections.connect(alias="default", host=MILVUS_HOST, port=MILVUS_PORT)
 
+
+# Connect sẵn lúc import để request đầu tiên không phải chờ; lỗi thì để ensure_connected thử lại sau
+try:
+    ensure_connected()
+except Exception as e:
+    print(f"⚠️ Milvus chưa sẵn sàng ({MILVUS_HOST}:{MILVUS_PORT}): {e}")
+
 def get_collection_name(bank_name: str) -> str:
     return f"bank_{bank_name.lower()}"
 
-def resolve_bank_collection(user_bank: str) -> str:
-    """Map tên ngân hàng user nhập sang collection hiện có trong Milvus."""
+def _list_collections() -> List[str]:
+    if _now() < _COLLS_CACHE["expires"]:
+        return _COLLS_CACHE["list"]
     ensure_connected()
     all_colls = utility.list_collections()
+    if set(all_colls) != set(_COLLS_CACHE["list"]):
+        # collection mới/xóa -> mapping cũ (kể cả None) không còn đúng
+        _BANK_COLL_CACHE.clear()
+    _COLLS_CACHE["list"] = all_colls
+    _COLLS_CACHE["expires"] = _now() + COLLS_CACHE_TTL
+    return all_colls
+
+def _match_collection(name: str, all_colls: List[str]) -> Optional[str]:
+    """Khớp tất định (exact / bank_<name> / prefix duy nhất) trước khi phải hỏi Gemini."""
+    for cand in (name, get_collection_name(name)):
+        if cand in all_colls:
+            return cand
+    prefixed = [c for c in all_colls if c.startswith(name) or c.startswith(get_collection_name(name))]
+    if len(prefixed) == 1:
+        return prefixed[0]
+    return None
+
+def resolve_bank_collection(user_bank: str) -> str:
+    """Map tên ngân hàng user nhập sang collection hiện có trong Milvus."""
+    name = (user_bank or "").strip().lower()
+    all_colls = _list_collections()
+    if name in _BANK_COLL_CACHE:
+        return _BANK_COLL_CACHE[name]
     print("RAG: ", all_colls)
+
+    matched = _match_collection(name, all_colls)
+    if matched:
+        _BANK_COLL_CACHE[name] = matched
+        return matched
+
     prompt = f"""
     Người dùng muốn truy vấn ngân hàng: "{user_bank}".
     Đây là danh sách collection có trong Milvus: {all_colls}.
@@ -26,9 +74,9 @@ def resolve_bank_collection(user_bank: str) -> str:
     ⚠️ Chỉ được trả về CHÍNH XÁC 1 tên từ danh sách trên (copy y nguyên).
     Nếu không có cái nào phù hợp thì trả về None.
     """
-    resp = _model.generate_content(prompt)
+    resp = get_model().generate_content(prompt)
     text = resp.text.strip()
     print("text AI promt: ",text)
-    if text in all_colls:
-        return text
-    return None
+    result = text if text in all_colls else None
+    _BANK_COLL_CACHE[name] = result
+    return result
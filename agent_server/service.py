@@ -3,107 +3,299 @@ service.py
 Core service logic for the agent.
 
 This module exposes `handle_ask` which orchestrates the planner (Gemini), tool calls
-(`bank_tool.get_account_summary`, `bank_tool.search_services`, `bank_tool.list_user_accounts`)
-and the final response synthesis via a local LLM (Ollama). It maintains a global
-`PENDING_ACTIONS` map to resume flows that require OTP verification.
+(`bank_tool.a_get_account_summary`, `bank_tool.a_search_services`, `bank_tool.a_list_user_accounts`)
+and the final response synthesis via a local LLM (Ollama). Flows that require OTP
+verification are parked in Redis (`pending:<user_id>`, short TTL) so any worker can
+resume them.
+
+`handle_ask` is a coroutine: Hub/RAG calls use the async `bank_tool.a_*` client, while
+blocking work (Gemini SDK, Redis chat history, Ollama) is pushed to worker threads so
+the event loop keeps serving other requests.  Ollama generations go through a small
+dedicated executor (`LLM_MAX_WORKERS`) so a burst of turns queues up instead of
+oversubscribing the CPU the model runs on.
 """
 
 from fastapi import HTTPException
+from hashlib import blake2b
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
+import asyncio
+import json
+import threading
 import uuid
-import requests
 
-from config import SERVICE_TOKEN
-from gemini_planner import call_gemini_planner
+import cachetools
+
+try:
+    import ahocorasick
+except ImportError:  # pyahocorasick is optional; fall back to plain substring checks
+    ahocorasick = None
+
+from config import SERVICE_TOKEN, LLM_MAX_WORKERS
+from gemini_planner import call_gemini_planner_for_user_async
 from bank_tool import (
-    get_account_summary,
+    a_get_account_summary,
+    a_get_accounts,
+    a_list_user_accounts,
+    a_search_services,
+    a_verify_otp_and_get_token,
     get_supported_banks,
-    list_user_accounts,
-    search_services,
-    verify_otp_and_get_token,
     NeedOTP
 )
 from ollama_wrapper import OllamaLLM
-from memory_manager import get_chat_history
+from memory_manager import get_chat_history, format_history, ar as aredis_client
 
 
 llm = OllamaLLM()
 
-# Global registry of pending actions keyed by user_id
-PENDING_ACTIONS: dict[str, dict[str, str]] = {}
+# Ollama generations in flight, shared by the buffered (executor) and streaming paths
+LLM_EXECUTOR = ThreadPoolExecutor(max_workers=LLM_MAX_WORKERS, thread_name_prefix="llm")
+_LLM_SLOTS = threading.BoundedSemaphore(LLM_MAX_WORKERS)
+
+# Keywords that route a prompt before (or instead of) the planner
+KW_ACCOUNT, KW_BALANCE, KW_TRANSACTION, KW_SERVICE = "tài khoản", "số dư", "giao dịch", "dịch vụ"
+INTENT_KEYWORDS = (KW_ACCOUNT, KW_BALANCE, KW_TRANSACTION, KW_SERVICE)
+
+if ahocorasick is not None:
+    _INTENT_AC = ahocorasick.Automaton()
+    for _kw in INTENT_KEYWORDS:
+        _INTENT_AC.add_word(_kw, _kw)
+    _INTENT_AC.make_automaton()
+else:
+    _INTENT_AC = None
+
+
+def intent_hits(prompt: str) -> set[str]:
+    """Set of `INTENT_KEYWORDS` found in the prompt (case-insensitive), in one pass."""
+    lower = prompt.lower()
+    if _INTENT_AC is not None:
+        return {kw for _, kw in _INTENT_AC.iter(lower)}
+    return {kw for kw in INTENT_KEYWORDS if kw in lower}
+
+
+# Pending actions (waiting for OTP) live in Redis keyed by user_id, shared by all workers;
+# abandoned flows expire with the OTP itself.
+PENDING_TTL = 300
+
+
+def _pending_key(user_id: str) -> str:
+    return f"pending:{user_id}"
+
+
+async def get_pending_action(user_id: str) -> dict[str, str] | None:
+    raw = await aredis_client.get(_pending_key(user_id))
+    return json.loads(raw) if raw else None
+
+
+async def set_pending_action(user_id: str, action: dict[str, str], ttl: int = PENDING_TTL) -> None:
+    await aredis_client.set(_pending_key(user_id), json.dumps(action), ex=ttl)
+
+
+async def pop_pending_action(user_id: str) -> None:
+    await aredis_client.delete(_pending_key(user_id))
 
+# Replies already generated by Ollama, keyed by a digest of everything that shapes the
+# answer.  Only the last 2 turns of history go into the key so a long session still hits.
+_REPLY_CACHE: cachetools.LRUCache = cachetools.LRUCache(maxsize=512)
+_REPLY_LOCK = threading.Lock()
 
-def synthesize_reply(user_prompt: str, intent: str, tool_data=None, gemini_text=None, context: str = "") -> str:
+
+# Static part of every Ollama prompt, built once at import
+SYSTEM_PROMPT = (
+    "Bạn là trợ lý liên ngân hàng của tập đoàn sovico thân thiện. "
+    "Nhiệm vụ của bạn là kết nối các thông tin liên quan theo yêu cầu và trả lời khách hàng bằng tiếng Việt, ngắn gọn nhưng đầy đủ. "
+    "Quy tắc:\n"
+    "- Ưu tiên sử dụng dữ liệu từ Tool (số dư, dịch vụ, giao dịch...).\n"
+    "- Nếu dữ liệu từ Tool thiếu hoặc trống, hãy tổng hợp từ Gemini và kiến thức nền.\n"
+    "- Nếu vẫn thiếu, hãy đưa ra danh sách dịch vụ cơ bản (thẻ tín dụng, chuyển khoản, gửi tiết kiệm, vay tiêu dùng, tra cứu số dư...).\n"
+    "- Không được trả lời chung chung kiểu 'ngân hàng có nhiều dịch vụ'. Luôn đưa ví dụ hoặc danh sách cụ thể.\n"
+    "- Giữ văn phong tự nhiên, rõ ràng, súc tích, thân thiện như đang trò chuyện trực tiếp."
+)
+_SYS_HEADER = f"<<SYS>>{SYSTEM_PROMPT}<<SYS>>\n\n--- Lịch sử hội thoại ---\n"
+
+
+def recent_turns(user_id: str, messages) -> str:
     """
-    Use the local LLM to generate a final answer given the raw tool data and/or planner text.
-    The system prompt enforces tone (natural, friendly, concise, Vietnamese only) and
-    instructs the LLM to prefer tool data when available.
+    History part of the reply-cache key: the user's id plus their last 2 chat messages,
+    whole.  The prompt carries more of this user's history than is keyed, so a cached reply
+    is only ever reused for the same user.
     """
-    system_prompt = (
-        "Bạn là trợ lý liên ngân hàng của tập đoàn sovico thân thiện. "
-        "Nhiệm vụ của bạn là kết nối các thông tin liên quan theo yêu cầu và trả lời khách hàng bằng tiếng Việt, ngắn gọn nhưng đầy đủ. "
-        "Quy tắc:\n"
-        "- Ưu tiên sử dụng dữ liệu từ Tool (số dư, dịch vụ, giao dịch...).\n"
-        "- Nếu dữ liệu từ Tool thiếu hoặc trống, hãy tổng hợp từ Gemini và kiến thức nền.\n"
-        "- Nếu vẫn thiếu, hãy đưa ra danh sách dịch vụ cơ bản (thẻ tín dụng, chuyển khoản, gửi tiết kiệm, vay tiêu dùng, tra cứu số dư...).\n"
-        "- Không được trả lời chung chung kiểu 'ngân hàng có nhiều dịch vụ'. Luôn đưa ví dụ hoặc danh sách cụ thể.\n"
-        "- Giữ văn phong tự nhiên, rõ ràng, súc tích, thân thiện như đang trò chuyện trực tiếp."
-    )
+    return "\x1e".join([user_id, *[f"{m.type}: {m.content}" for m in messages[-2:]]])
 
-    # Compose a human-readable representation of tool_data
-    tool_text = ""
-    if tool_data:
-        if intent == "get_account_summary":
-            tool_text = (
-                f"Tài khoản: {tool_data['account_label']}\n"
-                f"Số dư: {tool_data['balance']}\n"
-                f"Giao dịch gần đây:\n"
-            )
-            for t in tool_data.get("recent_transactions", []):
-                tool_text += f"- {t['date']}: {t['amount']} ({t['merchant']})\n"
-            if tool_data.get("last_update"):
-                tool_text += f"Cập nhật: {tool_data['last_update']}"
-        elif intent == "list_user_accounts":
-            tool_text = "Danh sách tài khoản của bạn:\n"
-            for bank, accounts in tool_data.items():
-                tool_text += f"- {bank}:\n"
-                for a in accounts:
-                    tool_text += f"   • {a['label']} (ID: {a['accountId']})\n"
-        else:
-            tool_text = str(tool_data)
 
-    # Build prompt for Ollama
+def _reply_key(user_prompt: str, tool_text: str, gemini_text: str, recent: str) -> bytes:
+    raw = "\x1f".join([SYSTEM_PROMPT, user_prompt, tool_text, gemini_text, recent])
+    return blake2b(raw.encode(), digest_size=16).digest()
+
+
+def _format_tool_data(intent: str, tool_data) -> str:
+    """Compose a human-readable representation of tool_data (built with one join, not +=)."""
+    if not tool_data:
+        return ""
+    if intent == "get_account_summary":
+        parts = [
+            f"Tài khoản: {tool_data['account_label']}\n"
+            f"Số dư: {tool_data['balance']}\n"
+            f"Giao dịch gần đây:\n"
+        ]
+        parts.extend(f"- {t['date']}: {t['amount']} ({t['merchant']})\n"
+                     for t in tool_data.get("recent_transactions", []))
+        if tool_data.get("last_update"):
+            parts.append(f"Cập nhật: {tool_data['last_update']}")
+        return "".join(parts)
+    if intent == "list_user_accounts":
+        parts = ["Danh sách tài khoản của bạn:\n"]
+        for bank, accounts in tool_data.items():
+            parts.append(f"- {bank}:\n")
+            parts.extend(f"   • {a['label']} (ID: {a['accountId']})\n" for a in accounts)
+        return "".join(parts)
+    return str(tool_data)
+
+
+def _build_reply_prompt(user_prompt: str, intent: str, tool_data=None, gemini_text=None,
+                        context: str = "", recent: str | None = None) -> tuple[bytes, str]:
+    """
+    Return (cache key, Ollama prompt) for a reply.  `recent` (see `recent_turns`) is the
+    history that goes into the key; without it the whole context is keyed.
+    """
+    tool_text = _format_tool_data(intent, tool_data)
     prompt_for_llama = (
-        f"<<SYS>>{system_prompt}<<SYS>>\n\n"
-        f"--- Lịch sử hội thoại ---\n{context}\n\n"
+        f"{_SYS_HEADER}{context}\n\n"
         f"--- Người dùng hỏi ---\n{user_prompt}\n\n"
         f"--- Tool data ---\n{tool_text}\n\n"
         f"--- Gemini text ---\n{gemini_text or ''}\n\n"
         f"Hãy tạo câu trả lời thân thiện cho khách hàng."
     )
-    return llm.invoke(prompt_for_llama)
+    key = _reply_key(user_prompt, tool_text, gemini_text or "", context if recent is None else recent)
+    return key, prompt_for_llama
+
+
+def synthesize_reply(user_prompt: str, intent: str, tool_data=None, gemini_text=None, context: str = "",
+                     recent: str | None = None) -> str:
+    """
+    Use the local LLM to generate a final answer given the raw tool data and/or planner text.
+    The system prompt enforces tone (natural, friendly, concise, Vietnamese only) and
+    instructs the LLM to prefer tool data when available.
+    """
+    key, prompt_for_llama = _build_reply_prompt(user_prompt, intent, tool_data, gemini_text, context, recent)
+    cached = _cached_reply(key)
+    if cached is not None:
+        return cached
+    return _generate_reply(key, prompt_for_llama)
+
+
+def _cached_reply(key: bytes) -> str | None:
+    with _REPLY_LOCK:
+        return _REPLY_CACHE.get(key)
+
+
+def _generate_reply(key: bytes, prompt_for_llama: str) -> str:
+    with _LLM_SLOTS:
+        reply = llm.invoke(prompt_for_llama)
+    with _REPLY_LOCK:
+        _REPLY_CACHE[key] = reply
+    return reply
+
+
+def synthesize_reply_stream(user_prompt: str, intent: str, tool_data=None, gemini_text=None,
+                            context: str = "", recent: str | None = None) -> Iterator[str]:
+    """
+    Same as `synthesize_reply` but yields the answer as Ollama generates it.  The full
+    reply is cached once the stream completes; a cache hit is yielded in one piece.
+    """
+    key, prompt_for_llama = _build_reply_prompt(user_prompt, intent, tool_data, gemini_text, context, recent)
+    cached = _cached_reply(key)
+    if cached is not None:
+        yield cached
+        return
+    parts = []
+    with _LLM_SLOTS:
+        for chunk in llm.stream(prompt_for_llama):
+            if not parts:
+                chunk = chunk.lstrip()
+                if not chunk:
+                    continue
+            parts.append(chunk)
+            yield chunk
+    reply = "".join(parts).strip()
+    with _REPLY_LOCK:
+        _REPLY_CACHE[key] = reply
+
+
+async def asynthesize_reply(user_prompt: str, intent: str, tool_data=None, gemini_text=None,
+                            context: str = "", recent: str | None = None) -> str:
+    """
+    `synthesize_reply` for coroutines: cache hits return on the loop, misses run the
+    blocking Ollama call on `LLM_EXECUTOR` so the event loop keeps serving requests.
+    """
+    key, prompt_for_llama = _build_reply_prompt(user_prompt, intent, tool_data, gemini_text, context, recent)
+    cached = _cached_reply(key)
+    if cached is not None:
+        return cached
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(LLM_EXECUTOR, _generate_reply, key, prompt_for_llama)
 
 
-def handle_ask(user_id: str, prompt: str, account_id: str | None = None,
-               bank_name: str = "mock", phone_num: str | None = None) -> dict:
+def _load_history(user_id: str):
+    chat_history = get_chat_history(user_id)
+    return chat_history, chat_history.messages
+
+
+def _record_turn(chat_history, prompt: str, answer: str) -> None:
+    chat_history.add_user_message(prompt)
+    chat_history.add_ai_message(answer)
+
+
+def _stream_and_record(chat_history, prompt: str, chunks: Iterator[str]) -> Iterator[str]:
+    """Pass chunks through and save the turn to history once the reply is complete."""
+    parts = []
+    for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+    _record_turn(chat_history, prompt, "".join(parts).strip())
+
+
+async def _reply(stream: bool, chat_history, prompt: str, source: str, *args, **kwargs) -> dict:
+    """
+    Synthesize the answer for `prompt` and record the turn.  With `stream=True` the
+    result carries a `reply_stream` iterator instead of `reply`; it is blocking and is
+    meant to be consumed from a worker thread (e.g. by `StreamingResponse`).
+    """
+    if stream:
+        chunks = synthesize_reply_stream(*args, **kwargs)
+        return {"reply_stream": _stream_and_record(chat_history, prompt, chunks), "source": source}
+    ans = await asynthesize_reply(*args, **kwargs)
+    await asyncio.to_thread(_record_turn, chat_history, prompt, ans)
+    return {"reply": ans, "source": source}
+
+
+async def handle_ask(user_id: str, prompt: str, account_id: str | None = None,
+                     bank_name: str = "mock", phone_num: str | None = None,
+                     stream: bool = False) -> dict:
     """
     Main entry point for processing a user prompt. Decides whether to resume an OTP
     flow, call the planner, invoke tools, or return a simple chat reply. Returns a
-    dictionary with a `reply` field containing the text answer.
+    dictionary with a `reply` field containing the text answer, or a `reply_stream`
+    iterator of text chunks when `stream=True` and the answer comes from the LLM.
     """
-    banks = get_supported_banks()
+    # Independent lookups: supported banks (Hub) and chat history (Redis) overlap
+    banks, (chat_history, past_messages) = await asyncio.gather(
+        asyncio.to_thread(get_supported_banks),
+        asyncio.to_thread(_load_history, user_id),
+    )
     if bank_name not in banks:
         msg = f"❌ Hệ thống chưa hỗ trợ ngân hàng {bank_name}. Vui lòng chọn trong: {', '.join(banks)}"
         return {"reply": msg, "source": "unsupported_bank"}
 
     trace_id = str(uuid.uuid4())
     print(f"[TRACE:{trace_id}] user_id={user_id}, ask={prompt}")
-    chat_history = get_chat_history(user_id)
-    past_messages = chat_history.messages
-    context = "\n".join([f"{m.type}: {m.content}" for m in past_messages])
+    context = format_history(past_messages)
+    recent = recent_turns(user_id, past_messages)
+    hits = intent_hits(prompt)
 
     # Nếu user nhập OTP
     if prompt.strip().isdigit() and len(prompt.strip()) in (5, 6):
-        pending = PENDING_ACTIONS.get(user_id)
+        pending = await get_pending_action(user_id)
         if pending:
             phone = pending["phone"]
             bank = pending["bank_name"]
@@ -111,57 +303,54 @@ def handle_ask(user_id: str, prompt: str, account_id: str | None = None,
             if not acct:
                 return {"reply": "❌ Thiếu account_id khi xác minh OTP", "source": "otp_failed"}
             try:
-                res = verify_otp_and_get_token(phone, prompt.strip(), bank, acct)
+                res = await a_verify_otp_and_get_token(phone, prompt.strip(), bank, acct)
                 account_summary = res.get("account_summary")
-                if account_summary:
-                    ans = synthesize_reply(
-                        "Xác thực OTP và trả số dư",
-                        "get_account_summary",
-                        tool_data=account_summary,
-                        context=context
-                    )
-                else:
-                    safe = get_account_summary(account_id=acct, phone_num=phone, bank_name=bank)
-                    ans = synthesize_reply(
-                        "Xác thực OTP và trả số dư",
-                        "get_account_summary",
-                        tool_data=safe,
-                        context=context
-                    )
-                PENDING_ACTIONS.pop(user_id, None)
-                chat_history.add_user_message(prompt)
-                chat_history.add_ai_message(ans)
-                return {"reply": ans, "source": "otp_verified_resume"}
+                if not account_summary:
+                    account_summary = await a_get_account_summary(account_id=acct, phone_num=phone, bank_name=bank)
+                out = await _reply(
+                    stream, chat_history, prompt, "otp_verified_resume",
+                    "Xác thực OTP và trả số dư",
+                    "get_account_summary",
+                    tool_data=account_summary,
+                    context=context,
+                    recent=recent
+                )
+                await pop_pending_action(user_id)
+                return out
             except Exception as e:
                 err_msg = f"Xác thực OTP thất bại: {str(e)}"
-                chat_history.add_user_message(prompt)
-                chat_history.add_ai_message(err_msg)
+                await asyncio.to_thread(_record_turn, chat_history, prompt, err_msg)
                 return {"reply": err_msg, "source": "otp_failed"}
 
     # Nếu user chỉ hỏi "tài khoản" (không có số dư/giao dịch) → liệt kê accounts
-    if "tài khoản" in prompt.lower() and "số dư" not in prompt.lower() and "giao dịch" not in prompt.lower():
-        accounts_by_bank = list_user_accounts(phone_num)
-        ans = synthesize_reply(prompt, "list_user_accounts", tool_data=accounts_by_bank, context=context)
-        chat_history.add_user_message(prompt)
-        chat_history.add_ai_message(ans)
-        return {"reply": ans, "source": "AI_list_accounts_shortcut"}
-
-    # Otherwise call the planner
-    planner_resp = call_gemini_planner(f"Lịch sử hội thoại:\n{context}\n\nUser hỏi: {prompt}")
+    if KW_ACCOUNT in hits and KW_BALANCE not in hits and KW_TRANSACTION not in hits:
+        accounts_by_bank = await a_list_user_accounts(phone_num)
+        return await _reply(stream, chat_history, prompt, "AI_list_accounts_shortcut",
+                            prompt, "list_user_accounts", tool_data=accounts_by_bank, context=context, recent=recent)
+
+    # Otherwise call the planner.  If it picks get_account_summary without an account_id we
+    # need the user's accounts; when the prompt looks like a balance/transaction lookup, fetch
+    # them concurrently (this also warms the accounts cache).  Other turns skip the Hub call.
+    planner_task = asyncio.create_task(call_gemini_planner_for_user_async(user_id, past_messages, prompt))
+    prefetch = KW_BALANCE in hits or KW_TRANSACTION in hits
+    if prefetch and not account_id and phone_num:
+        accounts_task = asyncio.create_task(a_get_accounts(phone_num, bank_name))
+    else:
+        accounts_task = asyncio.create_task(asyncio.sleep(0, result=None))
+    planner_resp, prefetched_accounts = await asyncio.gather(planner_task, accounts_task, return_exceptions=True)
+    if isinstance(planner_resp, BaseException):
+        raise planner_resp
     intent_type = planner_resp.get("type")
 
     # Case 1: plain answer from planner
     if intent_type == "final":
-        if "dịch vụ" in prompt.lower():
-            services = search_services(query=prompt, bank_name=bank_name)
-            ans = synthesize_reply(prompt, "search_services", tool_data=services, context=context)
-            chat_history.add_user_message(prompt)
-            chat_history.add_ai_message(ans)
-            return {"reply": ans, "source": "llama_wrap_service"}
-        ans = synthesize_reply(prompt, "chitchat", gemini_text=planner_resp.get("text"), context=context)
-        chat_history.add_user_message(prompt)
-        chat_history.add_ai_message(ans)
-        return {"reply": ans, "source": "llama_wrap_final"}
+        if KW_SERVICE in hits:
+            services = await a_search_services(query=prompt, bank_name=bank_name)
+            return await _reply(stream, chat_history, prompt, "llama_wrap_service",
+                                prompt, "search_services", tool_data=services, context=context, recent=recent)
+        return await _reply(stream, chat_history, prompt, "llama_wrap_final",
+                            prompt, "chitchat", gemini_text=planner_resp.get("text"),
+                            context=context, recent=recent)
 
     # Case 2: planner wants to call a function
     if intent_type == "function_call":
@@ -171,38 +360,32 @@ def handle_ask(user_id: str, prompt: str, account_id: str | None = None,
             account_id_from_planner = planner_resp["arguments"].get("account_id")
             acct = account_id or account_id_from_planner
 
-            # auto resolve từ phone nếu chưa có
+            # auto resolve từ phone nếu chưa có (danh sách thường đã lấy song song với planner)
             if not acct and phone_num:
-                try:
-                    accounts = requests.get(
-                        f"http://localhost:4000/bank/{bank_name}/accounts/{phone_num}",
-                        timeout=10
-                    ).json()
-                    if accounts:
-                        acct = accounts[0]["accountId"]
-                except Exception as e:
-                    print(f"[TRACE:{trace_id}] ⚠️ Error auto-resolve account_id: {e}")
+                if prefetched_accounts is None:
+                    try:
+                        prefetched_accounts = await a_get_accounts(phone_num, bank_name)
+                    except Exception as e:
+                        prefetched_accounts = e
+                if isinstance(prefetched_accounts, BaseException):
+                    print(f"[TRACE:{trace_id}] ⚠️ Error auto-resolve account_id: {prefetched_accounts}")
+                elif prefetched_accounts:
+                    acct = prefetched_accounts[0]["accountId"]
 
             if not acct:
                 clarification = "Bạn muốn kiểm tra số dư ở ngân hàng nào?"
-                chat_history.add_user_message(prompt)
-                chat_history.add_ai_message(clarification)
+                await asyncio.to_thread(_record_turn, chat_history, prompt, clarification)
                 return {"reply": clarification, "source": "clarification"}
 
             try:
-                safe = get_account_summary(account_id=acct, phone_num=phone_num, bank_name=bank_name)
-                ans = synthesize_reply(prompt, "get_account_summary", tool_data=safe, context=context)
-                chat_history.add_user_message(prompt)
-                chat_history.add_ai_message(ans)
-                return {"reply": ans, "source": "AI_summary_Account"}
+                safe = await a_get_account_summary(account_id=acct, phone_num=phone_num, bank_name=bank_name)
+                return await _reply(stream, chat_history, prompt, "AI_summary_Account",
+                                    prompt, "get_account_summary", tool_data=safe, context=context, recent=recent)
             except NeedOTP as n:
                 acct_id = n.account_id or acct
                 if not acct_id:
                     try:
-                        accounts = requests.get(
-                            f"http://localhost:4000/bank/{n.bank_name or bank_name}/accounts/{n.phone}",
-                            timeout=10
-                        ).json()
+                        accounts = await a_get_accounts(n.phone, n.bank_name or bank_name)
                         if accounts:
                             acct_id = accounts[0]["accountId"]
                     except Exception as e:
@@ -211,12 +394,12 @@ def handle_ask(user_id: str, prompt: str, account_id: str | None = None,
                 if not acct_id:
                     raise HTTPException(status_code=500, detail="Thiếu account_id khi yêu cầu OTP")
 
-                PENDING_ACTIONS[user_id] = {
+                await set_pending_action(user_id, {
                     "phone": n.phone,
                     "bank_name": n.bank_name or bank_name,
                     "action": "get_account_summary",
                     "account_id": acct_id
-                }
+                })
                 msg = (
                     f"Ngân hàng {n.bank_name or bank_name} đã gửi mã OTP tới số {n.phone} "
                     f"cho tài khoản {acct_id}. Vui lòng nhập mã OTP để xác thực."
@@ -230,27 +413,22 @@ def handle_ask(user_id: str, prompt: str, account_id: str | None = None,
             phone = planner_resp["arguments"].get("phone_num") or phone_num
             if not phone:
                 return {"reply": "❌ Thiếu phone_num để tra cứu tài khoản", "source": "AI_list_accounts_failed"}
-            accounts_by_bank = list_user_accounts(phone)
-            ans = synthesize_reply(prompt, "list_user_accounts", tool_data=accounts_by_bank, context=context)
-            chat_history.add_user_message(prompt)
-            chat_history.add_ai_message(ans)
-            return {"reply": ans, "source": "AI_list_accounts"}
+            accounts_by_bank = await a_list_user_accounts(phone)
+            return await _reply(stream, chat_history, prompt, "AI_list_accounts",
+                                prompt, "list_user_accounts", tool_data=accounts_by_bank, context=context, recent=recent)
 
         elif fn == "search_services":
             query = planner_resp["arguments"].get("query")
             bank = planner_resp["arguments"].get("bank_name", bank_name)
             if not query:
                 raise HTTPException(status_code=400, detail="query required")
-            services = search_services(query=query, bank_name=bank)
-            ans = synthesize_reply(prompt, "search_services", tool_data=services, context=context)
-            chat_history.add_user_message(prompt)
-            chat_history.add_ai_message(ans)
-            return {"reply": ans, "source": "AI_service"}
+            services = await a_search_services(query=query, bank_name=bank)
+            return await _reply(stream, chat_history, prompt, "AI_service",
+                                prompt, "search_services", tool_data=services, context=context, recent=recent)
 
         else:
-            ans = synthesize_reply(prompt, "unsupported", gemini_text=f"⚠️ Function {fn} chưa hỗ trợ.", context=context)
-            chat_history.add_user_message(prompt)
-            chat_history.add_ai_message(ans)
-            return {"reply": ans, "source": "AI_tools_unsupported"}
+            return await _reply(stream, chat_history, prompt, "AI_tools_unsupported",
+                                prompt, "unsupported", gemini_text=f"⚠️ Function {fn} chưa hỗ trợ.",
+                                context=context, recent=recent)
 
     raise HTTPException(status_code=500, detail="Unexpected planner response.")
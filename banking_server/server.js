@@ -108,12 +108,30 @@ app.get('/health', (_, res) => {
 });
 
 // List accounts of a user in a bank
+// Accept: application/x-ndjson -> 1 account mỗi dòng (client dừng đọc sớm được)
 app.get('/bank/:bank/accounts/:phone', (req, res) => {
   const { phone, bank } = req.params;
   const accounts = USERS[phone]?.[bank] || [];
+  if ((req.get('Accept') || '').includes('application/x-ndjson')) {
+    res.type('application/x-ndjson');
+    accounts.forEach(a => res.write(JSON.stringify(a) + '\n'));
+    return res.end();
+  }
   res.json(accounts);
 });
 
+// List accounts of a user across all banks in one call
+// body: { phone, banks?: [...] } -> { [bank]: [account, ...] } (chỉ các bank user có account)
+app.post('/accounts/bulk', (req, res) => {
+  const { phone, banks } = req.body || {};
+  if (!phone) return res.status(400).json({ error: 'phone required' });
+  const byBank = USERS[phone] || {};
+  const wanted = Array.isArray(banks) && banks.length ? banks : Object.keys(byBank);
+  const out = {};
+  wanted.forEach(b => { if (byBank[b]?.length) out[b] = byBank[b]; });
+  res.json(out);
+});
+
 // Request OTP
 app.post('/bank/:bank/balance', async (req, res) => {
   const { phone, account_id } = req.body || {};
@@ -1,29 +1,56 @@
 # ui_agent.py
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
+import asyncio
 import threading
-import time
 import json
-import websocket
 import queue
+import websockets
+from websockets.exceptions import ConnectionClosed
+
+try:
+    import uvloop
+except ImportError:  # uvloop là tùy chọn (có sẵn qua uvicorn[standard])
+    uvloop = None
 
 # Endpoints
 AI_API = os.getenv("AI_API", "http://localhost:8000/ask")
+AI_STREAM_API = os.getenv("AI_STREAM_API", f"{AI_API.rstrip('/')}/stream")
 BANK_API = os.getenv("BANK_API", "http://localhost:4000")
 DEFAULT_PHONE = os.getenv("DEFAULT_PHONE", "demo:thao")
 WS_URL = os.getenv("BANK_WS", "ws://localhost:4000/ws")
+# Số SMS tối đa giữ trong inbox (cũ hơn bị bỏ)
+SMS_INBOX_MAX = 200
 
 st.set_page_config(page_title="💬 Multi-Service Agent", layout="centered")
 st.title("💬 Multi-Service Agent")
 
+# ---------- HTTP ----------
+@st.cache_resource
+def get_session() -> requests.Session:
+    """1 Session cho cả app (cache qua các lần rerun): keep-alive tới Agent và Bank API."""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=64,
+        max_retries=Retry(total=2, backoff_factor=0.1, status_forcelist=[502, 503, 504]),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+http = get_session()
+
 # ---------- State ----------
 if "chat_history" not in st.session_state:
     st.session_state["chat_history"] = []
 if "sms_inbox" not in st.session_state:
     st.session_state["sms_inbox"] = []
-if "ws_thread_running" not in st.session_state:
-    st.session_state["ws_thread_running"] = False
+if "ws_phone" not in st.session_state:
+    st.session_state["ws_phone"] = None
 if "current_phone" not in st.session_state:
     st.session_state["current_phone"] = DEFAULT_PHONE
 
@@ -31,39 +58,89 @@ if "current_phone" not in st.session_state:
 if "ws_queue" not in st.session_state:
     st.session_state["ws_queue"] = queue.Queue()
 
+# ---------- SSE ----------
+def iter_sse(resp):
+    """Yield text deltas from the agent's /ask/stream server-sent events."""
+    for line in resp.iter_lines(decode_unicode=True):
+        if not line or not line.startswith("data:"):
+            continue
+        event = json.loads(line[5:])
+        if "error" in event:
+            raise RuntimeError(event["error"])
+        if event.get("done"):
+            return
+        yield event.get("delta", "")
+
 # ---------- WS listener ----------
-def ws_listener(phone: str, q: queue.Queue):
-    url = f"{WS_URL}?phone={phone}"
+class WSSupervisor:
+    """
+    1 thread + 1 event loop asyncio cho mọi kết nối WS của app: mỗi phone là 1 task
+    (dù nhiều session cùng nghe), tin nhận được đẩy vào queue của từng session đăng ký.
+    """
 
-    def on_message(ws, message):
-        try:
-            data = json.loads(message)
-        except:
-            data = {"event": "raw", "payload": message}
-        q.put(data)  # ✅ chỉ push vào queue
+    def __init__(self) -> None:
+        self.loop = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._subscribers: dict[str, set[queue.Queue]] = {}
+        threading.Thread(target=self.loop.run_forever, name="ws-supervisor", daemon=True).start()
 
-    def on_error(ws, err):
-        q.put({"event": "ws_error", "payload": str(err)})
+    def subscribe(self, phone: str, q: queue.Queue) -> None:
+        self.loop.call_soon_threadsafe(self._subscribe, phone, q)
 
-    def on_close(ws, *_):
-        q.put({"event": "ws_closed", "payload": f"closed for {phone}"})
+    def unsubscribe(self, phone: str, q: queue.Queue) -> None:
+        self.loop.call_soon_threadsafe(self._unsubscribe, phone, q)
 
-    def on_open(ws):
-        q.put({"event": "ws_open", "payload": f"connected for {phone}"})
+    # các hàm dưới chỉ chạy trên loop của supervisor
+    def _subscribe(self, phone: str, q: queue.Queue) -> None:
+        self._subscribers.setdefault(phone, set()).add(q)
+        task = self._tasks.get(phone)
+        if task is None or task.done():
+            self._tasks[phone] = self.loop.create_task(self._listen(phone))
 
-    while True:
-        try:
-            ws = websocket.WebSocketApp(
-                url,
-                on_message=on_message,
-                on_error=on_error,
-                on_close=on_close,
-                on_open=on_open,
-            )
-            ws.run_forever()
-        except Exception as e:
-            q.put({"event": "ws_exception", "payload": str(e)})
-        time.sleep(2)  # backoff
+    def _unsubscribe(self, phone: str, q: queue.Queue) -> None:
+        subs = self._subscribers.get(phone)
+        if subs is None:
+            return
+        subs.discard(q)
+        if not subs:
+            del self._subscribers[phone]
+            task = self._tasks.pop(phone, None)
+            if task:
+                task.cancel()
+
+    def _publish(self, phone: str, data: dict) -> None:
+        for q in self._subscribers.get(phone, ()):
+            q.put(data)  # ✅ chỉ push vào queue
+
+    async def _listen(self, phone: str) -> None:
+        url = f"{WS_URL}?phone={phone}"
+        retries = 0
+        while True:
+            try:
+                async with websockets.connect(url) as ws:
+                    retries = 0
+                    self._publish(phone, {"event": "ws_open", "payload": f"connected for {phone}"})
+                    async for message in ws:
+                        try:
+                            data = json.loads(message)
+                        except ValueError:
+                            data = {"event": "raw", "payload": message}
+                        self._publish(phone, data)
+                self._publish(phone, {"event": "ws_closed", "payload": f"closed for {phone}"})
+            except ConnectionClosed as e:
+                self._publish(phone, {"event": "ws_closed", "payload": f"closed for {phone}: {e}"})
+            except OSError as e:
+                self._publish(phone, {"event": "ws_error", "payload": str(e)})
+            except Exception as e:
+                self._publish(phone, {"event": "ws_exception", "payload": str(e)})
+            # exponential backoff, không block các phone khác
+            await asyncio.sleep(min(2 ** retries, 30))
+            retries += 1
+
+
+@st.cache_resource
+def get_ws_supervisor() -> WSSupervisor:
+    return WSSupervisor()
 
 # UI controls for phone subscribe
 with st.sidebar:
@@ -72,14 +149,13 @@ with st.sidebar:
     colA, colB = st.columns(2)
     if colA.button("🔌 Kết nối WS"):
         st.session_state["current_phone"] = new_phone.strip() or DEFAULT_PHONE
-        if not st.session_state["ws_thread_running"]:
-            t = threading.Thread(
-                target=ws_listener,
-                args=(st.session_state["current_phone"], st.session_state["ws_queue"]),
-                daemon=True,
-            )
-            t.start()
-            st.session_state["ws_thread_running"] = True
+        supervisor = get_ws_supervisor()
+        old_phone = st.session_state["ws_phone"]
+        if old_phone != st.session_state["current_phone"]:
+            if old_phone:
+                supervisor.unsubscribe(old_phone, st.session_state["ws_queue"])
+            supervisor.subscribe(st.session_state["current_phone"], st.session_state["ws_queue"])
+            st.session_state["ws_phone"] = st.session_state["current_phone"]
         st.success(f"Đang nghe SMS cho {st.session_state['current_phone']}")
 
 # Tabs
@@ -95,15 +171,22 @@ with tab1:
         if not user_input.strip():
             st.warning("⚠️ Nhập tin nhắn trước.")
         else:
+            # Chỗ hiện tạm câu trả lời đang stream; xóa sau khi đã vào lịch sử để không hiện 2 lần
+            placeholder = st.empty()
             try:
                 payload = {"phone_num": phone_number, "message": user_input}
-                resp = requests.post(AI_API, json=payload, timeout=15)
-                data = resp.json()
-                reply = data.get("reply") or data.get("text") or str(data)
+                # Hiện câu trả lời ngay khi Ollama sinh token (connect 5s, mỗi chunk tối đa 120s)
+                with http.post(AI_STREAM_API, json=payload, stream=True, timeout=(5, 120)) as resp:
+                    if resp.status_code != 200:
+                        data = resp.json()
+                        raise RuntimeError(data.get("detail") or str(data))
+                    reply = placeholder.write_stream(iter_sse(resp))
                 st.session_state["chat_history"].append(("👤 Bạn", user_input))
                 st.session_state["chat_history"].append(("🤖 Agent", reply))
             except Exception as e:
                 st.error(f"❌ Lỗi khi gửi API: {e}")
+            finally:
+                placeholder.empty()
 
     st.subheader("📜 Lịch sử trò chuyện")
     for role, msg in st.session_state["chat_history"]:
@@ -124,7 +207,7 @@ with tab2:
     with col1:
         if st.button("📊 Yêu cầu xem số dư", key="req_balance"):
             try:
-                r = requests.post(
+                r = http.post(
                     f"{BANK_API}/bank/{bank_name}/balance",
                     json={"phone": bank_phone, "account_id": account_id},
                     timeout=10,
@@ -140,7 +223,7 @@ with tab2:
     otp_code = st.text_input("🔑 Nhập OTP:", key="bank_otp")
     if st.button("✅ Xác minh OTP", key="verify_balance"):
         try:
-            r = requests.post(
+            r = http.post(
                 f"{BANK_API}/bank/{bank_name}/otp/verify",
                 json={"phone": bank_phone, "otp": otp_code, "account_id": account_id},
                 timeout=10,
@@ -158,13 +241,19 @@ with tab2:
 with tab3:
     st.subheader(f"📨 SMS Inbox (phone: {st.session_state['current_phone']})")
 
-    # 👉 Poll queue và append vào session_state
-    while not st.session_state["ws_queue"].empty():
-        msg = st.session_state["ws_queue"].get()
-        st.session_state["sms_inbox"].append(msg)
+    # 👉 Lấy hết queue 1 lượt (get_nowait, không block) và chỉ giữ SMS_INBOX_MAX tin mới nhất
+    q = st.session_state["ws_queue"]
+    new_msgs = []
+    try:
+        while True:
+            new_msgs.append(q.get_nowait())
+    except queue.Empty:
+        pass
+    if new_msgs:
+        st.session_state["sms_inbox"] = (st.session_state["sms_inbox"] + new_msgs)[-SMS_INBOX_MAX:]
 
     if st.session_state["sms_inbox"]:
-        for m in st.session_state["sms_inbox"][::-1]:
+        for m in reversed(st.session_state["sms_inbox"]):
             ev = m.get("event")
             pl = m.get("payload", {})
             if ev == "otp_sent":
@@ -1,7 +1,8 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, BackgroundTasks
 from pydantic import BaseModel, Field
 from typing import List, Dict, Any
-import os, json
+from concurrent.futures import Future
+import os, json, queue, threading, time
 import numpy as np
 
 from pymilvus import (
@@ -12,6 +13,24 @@ from pymilvus import (
 )
 from sentence_transformers import SentenceTransformer
 
+try:
+    import orjson
+
+    def _dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode()
+
+    _loads = orjson.loads
+except ImportError:  # orjson chưa cài -> dùng json chuẩn
+    def _dumps(obj: Any) -> str:
+        return json.dumps(obj, ensure_ascii=False)
+
+    _loads = json.loads
+
+try:
+    from numba import njit, prange
+except ImportError:  # numba là tùy chọn; không có thì dùng bản numpy
+    njit = None
+
 MILVUS_HOST = os.getenv("MILVUS_HOST", "localhost")
 MILVUS_PORT = os.getenv("MILVUS_PORT", "19530")
 
@@ -23,6 +42,7 @@ def _startup_event() -> None:
     if not connections.has_connection("default"):
         print(f"🔌 Connecting to Milvus at {MILVUS_HOST}:{MILVUS_PORT}")
         connections.connect(alias="default", host=MILVUS_HOST, port=MILVUS_PORT)
+    embedder.start()
 
 @app.on_event("shutdown")
 def _shutdown_event() -> None:
@@ -31,16 +51,283 @@ def _shutdown_event() -> None:
 
 # --- Embedding model ---
 MODEL_NAME = os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
-model = SentenceTransformer(MODEL_NAME)
+# "onnx" -> MiniLM export sang ONNX + dynamic INT8 (VNNI) qua onnxruntime; mặc định "torch"
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch").lower()
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", os.path.join(os.path.dirname(__file__), "onnx_model"))
+
+
+def _mean_pool_np(hidden: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    summed = np.einsum("bsh,bs->bh", hidden, mask)
+    return summed / np.clip(mask.sum(axis=1, keepdims=True), 1e-9, None)
+
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _mean_pool_jit(hidden, mask):
+        b, s, h = hidden.shape
+        out = np.zeros((b, h), dtype=np.float32)
+        for i in prange(b):
+            n = 0.0
+            for j in range(s):
+                w = mask[i, j]
+                if w != 0.0:
+                    n += w
+                    for k in range(h):
+                        out[i, k] += hidden[i, j, k] * w
+            if n < 1e-9:
+                n = 1e-9
+            for k in range(h):
+                out[i, k] /= n
+        return out
+
+
+def mean_pool(hidden: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """Mean-pool token embeddings theo attention mask -> (batch, hidden) float32."""
+    hidden = np.ascontiguousarray(hidden, dtype=np.float32)
+    mask = np.ascontiguousarray(mask, dtype=np.float32)
+    if njit is not None:
+        return _mean_pool_jit(hidden, mask)
+    return _mean_pool_np(hidden, mask)
+
+
+class OnnxEmbedder:
+    """
+    Thay thế SentenceTransformer trên CPU: model export ONNX, quantize INT8 động 1 lần
+    (lưu ở ONNX_MODEL_DIR), encode = tokenize -> session -> mean-pool -> L2-normalize.
+    Giữ cùng interface encode()/get_sentence_embedding_dimension() để EmbeddingBatcher dùng y nguyên.
+    """
+
+    def __init__(self, model_name: str, model_dir: str, max_length: int = 256) -> None:
+        from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        from transformers import AutoTokenizer
+
+        if "/" not in model_name:
+            model_name = f"sentence-transformers/{model_name}"
+        quant_file = "model_quantized.onnx"
+        if not os.path.exists(os.path.join(model_dir, quant_file)):
+            print(f"⚙️ Exporting {model_name} to ONNX INT8 at {model_dir}")
+            fp32 = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True)
+            quantizer = ORTQuantizer.from_pretrained(fp32)
+            quantizer.quantize(save_dir=model_dir,
+                               quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False))
+            AutoTokenizer.from_pretrained(model_name).save_pretrained(model_dir)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_dir, file_name=quant_file, provider="CPUExecutionProvider")
+        self.max_length = max_length
+        self._dim = self.model.config.hidden_size
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self._dim
+
+    def encode(self, texts: List[str], batch_size: int = 32, convert_to_numpy: bool = True,
+               normalize_embeddings: bool = True) -> np.ndarray:
+        out = []
+        for i in range(0, len(texts), batch_size):
+            enc = self.tokenizer(texts[i:i + batch_size], padding=True, truncation=True,
+                                 max_length=self.max_length, return_tensors="np")
+            hidden = self.model(**enc).last_hidden_state
+            hidden = hidden.numpy() if hasattr(hidden, "numpy") else np.asarray(hidden)
+            pooled = mean_pool(hidden, enc["attention_mask"])
+            if normalize_embeddings:
+                pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            out.append(pooled.astype(np.float32, copy=False))
+        return np.concatenate(out) if out else np.empty((0, self._dim), dtype=np.float32)
+
+
+def _load_model():
+    if EMBEDDING_BACKEND == "onnx":
+        try:
+            return OnnxEmbedder(MODEL_NAME, ONNX_MODEL_DIR)
+        except Exception as e:
+            print(f"⚠️ ONNX backend unavailable ({e}); falling back to SentenceTransformer")
+    return SentenceTransformer(MODEL_NAME)
+
+
+model = _load_model()
 VECTOR_DIMENSION = model.get_sentence_embedding_dimension()
 
 
+class EmbeddingBatcher:
+    """
+    Micro-batching cho model.encode: các request đồng thời (endpoint sync chạy trên
+    threadpool) đẩy text vào queue, 1 worker thread gom trong cửa sổ ngắn rồi encode
+    1 lần cho cả batch và trả kết quả về từng Future.
+    Input lớn hơn max_batch (ingest hàng loạt) không đi qua queue mà encode ngay trên
+    thread của request, để không giữ worker duy nhất và chặn các query rag_search.
+    """
+
+    def __init__(self, model, window: float = 0.005, max_batch: int = 32) -> None:
+        self.model = model
+        self.window = window
+        self.max_batch = max_batch
+        self._q: "queue.Queue[tuple[list[str], Future]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._thread.start()
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        if not texts:
+            return np.empty((0, VECTOR_DIMENSION), dtype=np.float32)
+        if len(texts) > self.max_batch:
+            return self._encode(texts)
+        self.start()
+        fut: Future = Future()
+        self._q.put((texts, fut))
+        return fut.result()
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        return self.model.encode(texts, batch_size=min(len(texts), 64),
+                                 convert_to_numpy=True, normalize_embeddings=True)
+
+    def _run(self) -> None:
+        while True:
+            items = [self._q.get()]
+            n = len(items[0][0])
+            deadline = time.monotonic() + self.window
+            while n < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._q.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                items.append(item)
+                n += len(item[0])
+
+            texts = [t for ts, _ in items for t in ts]
+            try:
+                embeds = self._encode(texts)
+            except Exception as e:
+                for _, fut in items:
+                    fut.set_exception(e)
+                continue
+            start = 0
+            for ts, fut in items:
+                fut.set_result(embeds[start:start + len(ts)])
+                start += len(ts)
+
+
+embedder = EmbeddingBatcher(model)
+
+
+# --- Index ---
+# Embedding luôn được L2-normalize -> IP chính là cosine (đúng objective của MiniLM),
+# không cần sqrt như L2. Collection cũ tạo bằng L2 vẫn search theo metric của index nó.
+DEFAULT_METRIC = "IP"
+HNSW_INDEX = {"index_type": "HNSW", "params": {"M": 16, "efConstruction": 200}}
+# Collection lớn: IVF_PQ nhẹ hơn HNSW nhiều lần về bộ nhớ (m phải chia hết cho dim).
+# Chuyển index là bước admin (POST /rag/admin/reindex), không chạy trong request ingest.
+IVF_PQ_MIN_ROWS = int(os.getenv("RAG_IVF_PQ_MIN_ROWS", 100_000))
+IVF_PQ_INDEX = {
+    "index_type": "IVF_PQ",
+    "params": {"nlist": 1024, "m": next(m for m in (48, 32, 24, 16, 8, 4, 2, 1) if VECTOR_DIMENSION % m == 0), "nbits": 8},
+}
+SEARCH_PARAMS = {"HNSW": {"ef": 64}, "IVF_PQ": {"nprobe": 16}}
+# Số dòng mỗi lần coll.insert trong rag_add
+INSERT_BATCH = int(os.getenv("RAG_INSERT_BATCH", 1000))
+
+# Handle Collection đã mở và đã load() -> không tốn RPC has_collection/load mỗi request
+_COLL_CACHE: Dict[str, Collection] = {}
+_LOADED: set[str] = set()
+# name -> {"index_type", "metric_type"} của index hiện tại
+_INDEX_INFO: Dict[str, Dict[str, str]] = {}
+# Collection đang build lại index (đã release -> không search/insert được tới khi xong)
+_REINDEXING: set[str] = set()
+_REINDEX_LOCK = threading.Lock()
+# name -> kết quả lần rebuild gần nhất ("running" | "done" | "failed" + error), xem qua GET /rag/admin/reindex/{name}
+_REINDEX_STATUS: Dict[str, Dict[str, Any]] = {}
+
+
+def _forget_collection(name: str) -> None:
+    _COLL_CACHE.pop(name, None)
+    _LOADED.discard(name)
+    _INDEX_INFO.pop(name, None)
+
+
+def _index_info(name: str, coll: Collection) -> Dict[str, str]:
+    info = _INDEX_INFO.get(name)
+    if info is None:
+        params = coll.indexes[0].params if coll.indexes else {}
+        info = {
+            "index_type": params.get("index_type", "HNSW"),
+            "metric_type": params.get("metric_type", DEFAULT_METRIC),
+        }
+        _INDEX_INFO[name] = info
+    return info
+
+
+def _to_l2(distance: float, metric: str) -> float:
+    """Quy điểm IP (vector chuẩn hóa) về khoảng cách L2² = 2 - 2·cos để giữ ngữ nghĩa max_distance."""
+    return 2.0 - 2.0 * distance if metric == "IP" else distance
+
+
+def _radius(max_distance: float, metric: str) -> float:
+    """Ngưỡng range search của Milvus tương ứng max_distance (L2²): L2 giữ nguyên, IP là cos tối thiểu."""
+    return 1.0 - max_distance / 2.0 if metric == "IP" else max_distance
+
+
+def _check_not_reindexing(name: str) -> None:
+    if name in _REINDEXING:
+        raise HTTPException(503, f"index rebuild in progress for {name}")
+
+
+def _rebuild_as_ivf_pq(name: str, metric: str) -> None:
+    """Build lại index của collection thành IVF_PQ (cùng metric). Chạy nền; name đã nằm trong _REINDEXING."""
+    coll = None
+    try:
+        print(f"🔁 Rebuilding index of {name} as IVF_PQ")
+        coll = Collection(name, using="default")
+        _forget_collection(name)
+        coll.release()
+        coll.drop_index()
+        coll.create_index("embedding", {**IVF_PQ_INDEX, "metric_type": metric})
+        coll.load()
+        _REINDEX_STATUS[name] = {"status": "done", "index_type": "IVF_PQ"}
+        print(f"✅ Index of {name} is now IVF_PQ")
+    except Exception as e:
+        print(f"⚠️ Rebuilding index of {name} failed: {e}")
+        status = {"status": "failed", "error": str(e), "index_type": None}
+        # đưa collection về trạng thái search được: index HNSW cũ (nếu đã bị drop) + load lại
+        try:
+            coll = coll or Collection(name, using="default")
+            if not coll.indexes:
+                coll.create_index("embedding", {**HNSW_INDEX, "metric_type": metric})
+            coll.load()
+            status["index_type"] = coll.indexes[0].params.get("index_type") if coll.indexes else None
+        except Exception as restore_err:
+            print(f"⚠️ Restoring index of {name} failed: {restore_err}")
+            status["restore_error"] = str(restore_err)
+        _REINDEX_STATUS[name] = status
+    finally:
+        _forget_collection(name)
+        with _REINDEX_LOCK:
+            _REINDEXING.discard(name)
+
+
+def _loaded_collection(name: str) -> Collection:
+    coll = _COLL_CACHE.get(name) or _COLL_CACHE.setdefault(name, Collection(name, using="default"))
+    if name not in _LOADED:
+        coll.load()
+        _LOADED.add(name)
+    return coll
+
+
 def ensure_collection(bank_name: str) -> Collection:
     """
     Đảm bảo collection tồn tại với đúng tên bank_name user nhập.
     Nếu chưa có thì tạo mới.
     """
     name = bank_name.lower().strip()
+    if name in _LOADED:
+        return _COLL_CACHE[name]
     if not utility.has_collection(name):
         fields = [
             FieldSchema(name="id", dtype=DataType.INT64, is_primary=True, auto_id=True),
@@ -50,31 +337,26 @@ def ensure_collection(bank_name: str) -> Collection:
         ]
         schema = CollectionSchema(fields, description=f"Collection for {bank_name}")
         coll = Collection(name=name, schema=schema, using="default", shards_num=1)
-        coll.create_index("embedding", {
-            "index_type": "HNSW", "metric_type": "L2",
-            "params": {"M": 16, "efConstruction": 200}
-        })
-        coll.load()
-        return coll
-    coll = Collection(name, using="default")
+        coll.create_index("embedding", {**HNSW_INDEX, "metric_type": DEFAULT_METRIC})
+        # schema mới -> bỏ handle cũ (nếu có) trước khi cache handle vừa tạo
+        _forget_collection(name)
+        _COLL_CACHE[name] = coll
+        return _loaded_collection(name)
+    coll = _COLL_CACHE.get(name) or _COLL_CACHE.setdefault(name, Collection(name, using="default"))
     if not coll.indexes:
-        coll.create_index("embedding", {
-            "index_type": "HNSW", "metric_type": "L2",
-            "params": {"M": 16, "efConstruction": 200}
-        })
-    coll.load()
-    return coll
+        coll.create_index("embedding", {**HNSW_INDEX, "metric_type": DEFAULT_METRIC})
+    return _loaded_collection(name)
 
 
 def chunk_text(text: str, max_chars: int = 1000, overlap: int = 100) -> list[str]:
-    chunks, start = [], 0
-    while start < len(text):
-        end = start + max_chars
-        chunks.append(text[start:end])
-        start = end - overlap
-        if start < 0:
-            start = 0
-    return chunks
+    """Cắt text thành các đoạn max_chars ký tự, 2 đoạn liền nhau chồng nhau overlap ký tự."""
+    if max_chars <= overlap:
+        raise ValueError("max_chars must be greater than overlap")
+    if not text:
+        return []
+    # đoạn cuối luôn chạm hết text; không sinh thêm đoạn nằm trọn trong phần overlap
+    step = max_chars - overlap
+    return [text[s:s + max_chars] for s in range(0, max(len(text) - overlap, 1), step)]
 
 
 # --- Schemas ---
@@ -89,6 +371,10 @@ class SearchRequest(BaseModel):
     k: int = 5
     max_distance: float = 1.5
 
+class ReindexRequest(BaseModel):
+    bank_name: str
+    force: bool = False  # build IVF_PQ kể cả khi chưa tới IVF_PQ_MIN_ROWS
+
 
 # --- Endpoints ---
 @app.get("/health")
@@ -103,45 +389,101 @@ def list_collections() -> Dict[str, List[str]]:
 def rag_add(req: AddRequest) -> Dict[str, Any]:
     if len(req.texts) != len(req.metadatas):
         raise HTTPException(400, "texts and metadatas must match length")
+    _check_not_reindexing(req.bank_name.lower().strip())
     coll = ensure_collection(req.bank_name)
 
-    final_texts, final_metas = [], []
+    final_texts, meta_strings = [], []
     for text, meta in zip(req.texts, req.metadatas):
         chunks = chunk_text(text)
-        for i, ch in enumerate(chunks):
-            final_texts.append(ch)
-            final_metas.append({**meta, "chunk_id": i, "orig_len": len(text)})
+        final_texts.extend(chunks)
+        meta_strings.extend(_dumps({**meta, "chunk_id": i, "orig_len": len(text)}) for i in range(len(chunks)))
 
-    embeds = model.encode(final_texts, convert_to_numpy=True)
-    meta_strings = [json.dumps(m, ensure_ascii=False) for m in final_metas]
-    result = coll.insert([embeds.tolist(), final_texts, meta_strings])
-    return {"ids": list(result.primary_keys), "chunks": len(final_texts)}
+    # chia batch để mỗi insert RPC không vượt giới hạn kích thước gRPC message; .tolist() theo
+    # từng batch (pymilvus 2.4 tự flatten vector thành list float, list Python nhanh hơn ndarray)
+    embeds = embedder.encode(final_texts)
+    name = req.bank_name.lower().strip()
+    _check_not_reindexing(name)
+    ids = []
+    try:
+        for i in range(0, len(final_texts), INSERT_BATCH):
+            j = i + INSERT_BATCH
+            result = coll.insert([embeds[i:j].tolist(), final_texts[i:j], meta_strings[i:j]])
+            ids.extend(result.primary_keys)
+    except Exception:
+        # collection bị drop/release từ bên ngoài -> lần sau ensure_collection kiểm tra/tạo lại
+        _forget_collection(name)
+        raise
+    return {"ids": ids, "chunks": len(final_texts)}
 
 @app.post("/rag/search")
 def rag_search(req: SearchRequest) -> Dict[str, Any]:
     name = req.bank_name.lower().strip()
-    if not utility.has_collection(name):
+    _check_not_reindexing(name)
+    if name not in _LOADED and not utility.has_collection(name):
         return {"results": []}
-    coll = Collection(name, using="default")
-    coll.load()
+    coll = _loaded_collection(name)
 
-    q_emb = model.encode([req.query], convert_to_numpy=True)
-    res = coll.search(q_emb.tolist(), "embedding",
-                      {"metric_type": "L2", "params": {"ef": 64}},
-                      limit=req.k,
-                      output_fields=["text", "metadata"])
+    q_emb = embedder.encode([req.query])
+    info = _index_info(name, coll)
+    metric = info["metric_type"]
+    # range search: Milvus chỉ trả hit trong ngưỡng (L2: distance < radius, IP: score > radius)
+    # nên được đủ k kết quả hợp lệ và không kéo text/metadata của hit bị loại về
+    params = {**SEARCH_PARAMS.get(info["index_type"], {}), "radius": _radius(req.max_distance, metric)}
+    try:
+        res = coll.search(q_emb, "embedding",
+                          {"metric_type": metric, "params": params},
+                          limit=req.k,
+                          output_fields=["text", "metadata"])
+    except Exception:
+        # collection bị drop/release từ bên ngoài -> lần sau mở lại từ đầu
+        _forget_collection(name)
+        raise
     results = []
     for hits in res:
         for hit in hits:
-            if float(hit.distance) <= req.max_distance:
-                meta = {}
-                try:
-                    meta = json.loads(hit.entity.get("metadata") or "{}")
-                except:
-                    pass
-                results.append({
-                    "text": hit.entity.get("text"),
-                    "distance": float(hit.distance),
-                    **meta
-                })
+            meta = {}
+            try:
+                meta = _loads(hit.entity.get("metadata") or "{}")
+            except:
+                pass
+            results.append({
+                "text": hit.entity.get("text"),
+                "distance": _to_l2(float(hit.distance), metric),
+                **meta
+            })
     return {"results": results}
+
+@app.post("/rag/admin/reindex", status_code=202)
+def rag_reindex(req: ReindexRequest, background: BackgroundTasks) -> Dict[str, Any]:
+    """
+    Chuyển index HNSW của collection sang IVF_PQ khi đã đủ lớn. Collection không search/add
+    được trong lúc build (trả 503), nên chạy ngoài giờ cao điểm; build chạy nền.
+    """
+    name = req.bank_name.lower().strip()
+    if not utility.has_collection(name):
+        raise HTTPException(404, f"collection {name} not found")
+    coll = Collection(name, using="default")
+    info = _index_info(name, coll)
+    rows = coll.num_entities
+    if info["index_type"] != "HNSW":
+        return {"status": "skipped", "index_type": info["index_type"], "rows": rows}
+    if rows < IVF_PQ_MIN_ROWS and not req.force:
+        return {"status": "skipped", "index_type": info["index_type"], "rows": rows,
+                "reason": f"fewer than {IVF_PQ_MIN_ROWS} rows"}
+    with _REINDEX_LOCK:
+        if name in _REINDEXING:
+            raise HTTPException(409, f"index rebuild already running for {name}")
+        _REINDEXING.add(name)
+        _REINDEX_STATUS[name] = {"status": "running", "index_type": "HNSW"}
+    background.add_task(_rebuild_as_ivf_pq, name, info["metric_type"])
+    return {"status": "started", "index_type": "IVF_PQ", "rows": rows}
+
+
+@app.get("/rag/admin/reindex/{bank_name}")
+def rag_reindex_status(bank_name: str) -> Dict[str, Any]:
+    """Trạng thái lần rebuild index gần nhất của collection (running / done / failed)."""
+    name = bank_name.lower().strip()
+    status = _REINDEX_STATUS.get(name)
+    if status is None:
+        raise HTTPException(404, f"no index rebuild recorded for {name}")
+    return {"bank_name": name, **status}